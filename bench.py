@@ -0,0 +1,492 @@
+"""
+⏱ БЕНЧМАРКИ БОТА ДОНОРСТВА
+Запуск: python bench.py [имя ...]   (без аргументов - все бенчмарки)
+"""
+
+import asyncio
+import gzip
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Update
+
+from main import (
+    BLOOD_GROUPS, WEEKDAYS_RU, ApiResponse, CallbackAction, CallbackCodec, CallbackData, GoogleScriptClient,
+    LocalStorage, StorageAdapter, TicketIssuer, WireCodec,
+    dump_json, extract_blood_group, extract_cancel, extract_date, extract_time, load_json, orjson,
+)
+
+BENCHMARKS: Dict[str, Callable[[], None]] = {}
+
+
+def benchmark(name: str):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def measure(func: Callable, *args, number: int = 200_000) -> float:
+    """Среднее время одного вызова в наносекундах"""
+    start = time.perf_counter()
+    for _ in range(number):
+        func(*args)
+    return (time.perf_counter() - start) / number * 1e9
+
+
+def report(title: str, rows: Dict[str, float], unit: str = "нс/вызов"):
+    print(f"\n{title}")
+    for label, value in rows.items():
+        print(f"  {label:<40} {value:>12.1f} {unit}")
+
+
+# ========== CALLBACK_DATA ==========
+def legacy_extract_blood_group(callback_data: str) -> Optional[str]:
+    if callback_data.startswith('blood_'):
+        return callback_data[6:]
+    if callback_data.startswith('CallbackData.BLOOD_PREFIX'):
+        return callback_data.replace('CallbackData.BLOOD_PREFIX', '')
+    if callback_data in ['A+', 'A-', 'B+', 'B-', 'AB+', 'AB-', 'O+', 'O-']:
+        return callback_data
+    return None
+
+
+def legacy_extract_date(callback_data: str) -> Optional[str]:
+    if callback_data.startswith('date_'):
+        return callback_data[5:]
+    if callback_data.startswith('CallbackData.DATE_PREFIX'):
+        return callback_data.replace('CallbackData.DATE_PREFIX', '')
+    return None
+
+
+def legacy_extract_time(callback_data: str) -> Optional[str]:
+    if callback_data.startswith('time_'):
+        return callback_data[5:]
+    if callback_data.startswith('CallbackData.TIME_PREFIX'):
+        return callback_data.replace('CallbackData.TIME_PREFIX', '')
+    return None
+
+
+def legacy_extract_cancel(callback_data: str):
+    parts = callback_data.split("_")
+    if len(parts) >= 4:
+        return parts[2], "_".join(parts[3:])
+    return None
+
+
+@benchmark("callbacks")
+def bench_callbacks():
+    ticket = "Т-пон-A+-1234"
+    legacy = {
+        "blood": "CallbackData.BLOOD_PREFIXAB+",
+        "date": "CallbackData.DATE_PREFIX2026-10-20",
+        "time": "CallbackData.TIME_PREFIX09:30",
+        "cancel": f"cancel_yes_2026-10-20_{ticket}",
+    }
+    encoded = {
+        "blood": CallbackCodec.encode(CallbackAction.BLOOD, "AB+"),
+        "date": CallbackCodec.encode(CallbackAction.DATE, "2026-10-20"),
+        "time": CallbackCodec.encode(CallbackAction.TIME, "09:30"),
+        "cancel": CallbackCodec.encode(CallbackAction.CANCEL_YES, "2026-10-20", TicketIssuer().issue()),
+    }
+
+    print("\nРазмер callback_data (старый -> новый, байт)")
+    for kind in legacy:
+        print(f"  {kind:<40} {len(legacy[kind].encode('utf-8')):>5} -> {len(encoded[kind].encode('utf-8'))}")
+
+    # Настоящий трафик - в основном разные кнопки разных пользователей, поэтому основная строка - разбор
+    # без кэша (функция под lru_cache), а попадание в кэш (та же кнопка повторно) - отдельной строкой
+    uncached_decode = CallbackCodec.decode.__wrapped__
+    legacy_extract = {
+        "blood": (legacy_extract_blood_group,), "date": (legacy_extract_date,),
+        "time": (legacy_extract_time,), "cancel": (legacy_extract_cancel,),
+    }
+    new_extract = {
+        "blood": (extract_blood_group,), "date": (extract_date,),
+        "time": (extract_time,), "cancel": (extract_cancel, CallbackAction.CANCEL_YES),
+    }
+    rows, slowdown = {}, []
+    for kind in legacy:
+        func, *extra = legacy_extract[kind]
+        old = rows[f"{kind}: старый extract"] = measure(func, legacy[kind], *extra)
+        new = rows[f"{kind}: decode без кэша"] = measure(uncached_decode, encoded[kind], number=50_000)
+        func, *extra = new_extract[kind]
+        rows[f"{kind}: extract_*, повтор из кэша"] = measure(func, encoded[kind], *extra)
+        slowdown.append(new / old)
+    report("Разбор callback_data", rows)
+    print(f"\n  Без кэша новый формат разбирается в {min(slowdown):.0f}-{max(slowdown):.0f} раз медленнее "
+          f"старых extract_*: выигрыш кодека - в размере callback_data и проверке формата, а не в скорости разбора")
+
+
+# ========== ПАРАЛЛЕЛЬНЫЕ ЧТЕНИЯ ==========
+class FakeResponse:
+    def __init__(self, payload: dict):
+        self.status_code = 200
+        self.content = dump_json(payload)
+
+    def json(self):
+        return load_json(self.content)
+
+
+def script_response(local: LocalStorage, payload: dict) -> dict:
+    """Ответ скрипта на данных LocalStorage; с "wire" в запросе - в компактном формате"""
+    action = payload["action"]
+    if action == "get_available_dates":
+        result = local.get_available_dates(int(payload.get("user_id", 0)))
+    elif action == "get_free_times":
+        result = local.get_free_times(payload["date"], payload["blood_group"])
+    else:
+        result = ApiResponse.success({})
+    if payload.get("wire") and result.status == "success":
+        data = WireCodec.compact(action, result.data, local.working_hours, payload.get("hours", ""))
+        return {"status": result.status, "wire": WireCodec.VERSION, "data": data}
+    return {"status": result.status, "data": result.data}
+
+
+class FakeSlowSession:
+    """Подмена requests.Session: отвечает данными LocalStorage с фиксированной задержкой"""
+    def __init__(self, latency: float, local: LocalStorage):
+        self.latency = latency
+        self.local = local
+        self.calls = 0
+
+    def post(self, url, data=None, json=None, headers=None, timeout=None):
+        self.calls += 1
+        time.sleep(self.latency)
+        return FakeResponse(script_response(self.local, json if json is not None else load_json(data)))
+
+
+def fake_google_storage(latency: float) -> StorageAdapter:
+    local = LocalStorage()
+    google = GoogleScriptClient("http://fake")
+    google.session = FakeSlowSession(latency, local)
+    return StorageAdapter("GOOGLE", google, local)
+
+
+async def _fanout_latencies(latency: float, rounds: int) -> Tuple[Dict[str, float], Dict[str, float]]:
+    storage = fake_google_storage(latency)
+    google = storage.google
+    date = storage.local.get_available_dates(0).data["available_dates"][0]["date"]
+
+    async def sequential():
+        google.clear_cache()
+        await storage.get_free_times(date, "A+")
+        await storage.get_available_dates(1)
+
+    async def gathered():
+        google.clear_cache()
+        await storage.gather(storage.get_free_times(date, "A+"), storage.get_available_dates(1))
+
+    async def blood_group_cold():
+        google.clear_cache()
+        await storage.get_available_dates(1)
+
+    def blood_group_after(think: float):
+        async def scenario():
+            google.clear_cache()
+            storage.prefetch("get_available_dates", 1)
+            await asyncio.sleep(latency * think)  # пользователь выбирает группу крови
+            start = time.perf_counter()
+            await storage.gather(storage.shared("get_available_dates", 1))
+            return time.perf_counter() - start
+        return scenario
+
+    calls = {}
+
+    async def timed(label, scenario):
+        total = 0.0
+        before = google.session.calls
+        for _ in range(rounds):
+            start = time.perf_counter()
+            measured = await scenario()
+            total += measured if measured is not None else time.perf_counter() - start
+        calls[label] = (google.session.calls - before) / rounds
+        return total / rounds * 1000
+
+    scenarios = {
+        "process_date: последовательно": sequential,
+        "process_date: storage.gather": gathered,
+        "process_blood_group: без prefetch": blood_group_cold,
+        # Клик раньше ответа прогрева: ждём ту же задачу (shared), второго запроса нет
+        "process_blood_group: клик через 0.3×": blood_group_after(0.3),
+        "process_blood_group: клик через 1.5×": blood_group_after(1.5),
+    }
+    latencies = {label: await timed(label, scenario) for label, scenario in scenarios.items()}
+    return latencies, calls
+
+
+@benchmark("fanout")
+def bench_fanout():
+    for latency in (0.05, 0.2):
+        rows, calls = asyncio.run(_fanout_latencies(latency, rounds=10))
+        report(f"Задержка чтений при ответе backend за {latency * 1000:.0f} мс", rows, unit="мс")
+        report("  запросов к upstream на сценарий", calls, unit="запр.")
+
+
+# ========== ФОРМАТ ОТВЕТОВ ==========
+def _parse_rows(label: str, body: bytes, expand: Callable) -> Dict[str, float]:
+    rows = {f"{label}: json.loads": measure(lambda raw: expand(json.loads(raw)), body, number=20_000)}
+    if orjson is not None:
+        rows[f"{label}: orjson.loads"] = measure(lambda raw: expand(orjson.loads(raw)), body, number=20_000)
+    return rows
+
+
+@benchmark("wire")
+def bench_wire():
+    local = LocalStorage(seed_test_data=True)
+    dates = local.get_available_dates(1).data
+    date = dates["available_dates"][0]["date"]
+    responses = {
+        "get_available_dates": dates,
+        "get_free_times": local.get_free_times(date, "A+").data,
+    }
+    hours_tag = WireCodec.fingerprint(local.working_hours)
+    for action, data in responses.items():
+        wire = WireCodec()
+        wire.hours = (hours_tag, local.working_hours)
+        full = dump_json({"status": "success", "data": data})
+        # Рабочие часы клиенту уже известны - как в установившемся режиме
+        compact = dump_json({"status": "success", "wire": WireCodec.VERSION,
+                             "data": WireCodec.compact(action, data, local.working_hours, hours_tag)})
+        print(f"\n{action}: байт в ответе (без gzip / gzip)")
+        print(f"  {'полный JSON':<40} {len(full):>5} / {len(gzip.compress(full))}")
+        print(f"  {'компактный wire':<40} {len(compact):>5} / {len(gzip.compress(compact))}")
+        rows = _parse_rows("полный", full, lambda result: result["data"])
+        rows.update(_parse_rows("компактный + expand", compact,
+                                lambda result, action=action, wire=wire: wire.expand(action, result["data"])))
+        report(f"{action}: разбор ответа{'' if orjson is not None else ' (orjson не установлен)'}", rows)
+
+
+# ========== ПАМЯТЬ ПОД ЗАПИСИ ==========
+@dataclass
+class LegacyBooking:
+    """Прежнее представление записи: все поля - строки"""
+    ticket: str
+    date: str
+    time: str
+    blood_group: str
+    day: str
+    user_id: int
+    created_at: Optional[str] = None
+
+
+def _booking_rows(count: int):
+    start = datetime.now()
+    hours = [f"{h:02d}:{m:02d}" for h in range(7, 14) for m in (0, 30)]
+    for i in range(count):
+        day = start + timedelta(days=1 + i % 30)
+        yield 100000 + i, day.strftime("%Y-%m-%d"), hours[i % len(hours)], BLOOD_GROUPS[i % 8], WEEKDAYS_RU[day.weekday()]
+
+
+def _copy(value: str) -> str:
+    return value.encode("utf-8").decode("utf-8")
+
+
+def _measure_memory(build) -> float:
+    tracemalloc.start()
+    holder = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del holder
+    return current / 1024 / 1024
+
+
+@benchmark("memory")
+def bench_memory():
+    for count in (100_000, 300_000):
+        rows = list(_booking_rows(count))
+
+        def legacy():
+            # Строки копируются: в боте каждая запись получает свои строки из callback_data
+            bookings = {}
+            for n, (user_id, date, time_slot, blood_group, day) in enumerate(rows):
+                ticket = f"Т-{day[:3]}-{blood_group}-{1000 + n % 9000}"
+                date, time_slot, blood_group, day = (_copy(v) for v in (date, time_slot, blood_group, day))
+                bookings.setdefault(user_id, {})[date] = LegacyBooking(
+                    ticket, date, time_slot, blood_group, day, user_id, datetime.now().isoformat())
+            return bookings
+
+        def compact():
+            storage = LocalStorage.__new__(LocalStorage)
+            storage.bookings, storage.tickets, storage.user_dates, storage.versions = {}, {}, {}, {}
+            storage.ticket_issuer = TicketIssuer()
+            for user_id, date, time_slot, blood_group, _ in rows:
+                storage._add_booking_sync(user_id, _copy(date), _copy(time_slot), _copy(blood_group))
+            return storage
+
+        report(f"Память на {count} записей", {
+            "старый dataclass + строки": _measure_memory(legacy),
+            "Booking (slots) + индекс талонов": _measure_memory(compact),
+        }, unit="МБ")
+
+
+# ========== ОТЧЁТЫ ==========
+async def _loop_lag(coro) -> Dict[str, float]:
+    """Время ответа и наибольшая задержка event loop, пока coro выполняется"""
+    worst, done = 0.0, False
+
+    async def ticker():
+        nonlocal worst
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            worst = max(worst, time.perf_counter() - start - 0.001)
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    await coro
+    wall = time.perf_counter() - start
+    done = True
+    await task
+    return {"ответ": wall * 1000, "задержка loop": worst * 1000}
+
+
+async def _report_timings(storage: LocalStorage) -> Dict[str, float]:
+    from main import ReportService
+
+    async def inline():
+        return storage.get_stats()
+
+    rows = {f"inline: {k}": v for k, v in (await _loop_lag(inline())).items()}
+    for executor in ("thread", "process"):
+        reports = ReportService(executor=executor)
+        reports.start()
+        await reports.local_stats(storage)  # прогрев: запуск процесса не входит в замер
+        rows.update({f"{executor}: {k}": v for k, v in (await _loop_lag(reports.local_stats(storage))).items()})
+        reports.shutdown()
+    return rows
+
+
+@benchmark("reports")
+def bench_reports():
+    for count in (100_000, 300_000):
+        storage = LocalStorage(seed_test_data=False)
+        for user_id, date, time_slot, blood_group, _ in _booking_rows(count):
+            storage._add_booking_sync(user_id, date, time_slot, blood_group)
+        report(f"Статистика по {count} записям", asyncio.run(_report_timings(storage)), unit="мс")
+
+
+# ========== СТАРТ ==========
+class NullSession(BaseSession):
+    """Сессия aiogram без сети: запросы к Telegram никуда не отправляются"""
+    async def make_request(self, bot, method, timeout=None):
+        return None
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+async def feed_first_update():
+    """Пропускает /start через диспетчер так же, как при polling"""
+    import main
+
+    bot = Bot(token="123456:TEST", session=NullSession())
+    dp = main.create_dispatcher()
+    update = Update.model_validate({
+        "update_id": 1,
+        "message": {
+            "message_id": 1, "date": int(time.time()), "text": "/start",
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "Bench"},
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    })
+    await dp.feed_update(bot, update)
+    await asyncio.sleep(0)
+
+
+@benchmark("startup")
+def bench_startup():
+    # main импортируется первым, чтобы STARTED_AT включал импорт aiogram, как при обычном запуске
+    script = ("import main, asyncio, bench; asyncio.run(bench.feed_first_update()); "
+              "print('RESULT', main.startup_metrics['first_update_ms'])")
+    rows = {}
+    for mode, seed in (("GOOGLE", "False"), ("LOCAL", "False"), ("LOCAL", "True")):
+        env = dict(os.environ, BOT_MODE=mode, SEED_TEST_DATA=seed)
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        wall = (time.perf_counter() - start) * 1000
+        result = [line for line in out.stdout.splitlines() if line.startswith("RESULT")]
+        if not result:
+            print(out.stdout, out.stderr)
+            continue
+        label = f"{mode}{' + тест. данные' if seed == 'True' else ''}"
+        rows[f"{label}: до 1-го обновления"] = float(result[0].split()[1])
+        rows[f"{label}: весь процесс"] = wall
+    report("Старт процесса -> первое обработанное обновление", rows, unit="мс")
+
+
+# ========== MIDDLEWARE ==========
+def _updates(count: int):
+    """Поток как при работе: /help и кнопка главного меню от 50 пользователей вперемешку"""
+    now = int(time.time())
+    for i in range(count):
+        user = {"id": 1000 + i % 50, "is_bot": False, "first_name": "Bench"}
+        message = {"message_id": i, "date": now, "chat": {"id": user["id"], "type": "private"}, "from": user}
+        if i % 2:
+            yield Update.model_validate({"update_id": i, "callback_query": {
+                "id": str(i), "from": user, "chat_instance": "bench", "message": dict(message, text="меню"),
+                "data": CallbackData.MAIN_MENU.value}})
+        else:
+            yield Update.model_validate({"update_id": i, "message": dict(
+                message, text="/help", entities=[{"type": "bot_command", "offset": 0, "length": 5}])})
+
+
+async def _middleware_timings(count: int) -> Dict[str, float]:
+    import main
+
+    bot = Bot(token="123456:TEST", session=NullSession())
+    updates = list(_updates(count))
+    rows = {}
+    with tempfile.TemporaryDirectory() as directory:
+        # Журнал пишется во временный каталог, чтобы его запись входила в замер
+        journal = main.journal.get()
+        journal.directory = directory
+        journal.open()
+        for profile in (False, True):
+            dp = main.create_dispatcher(profile=profile)
+            start = time.perf_counter()
+            for update in updates:
+                await dp.feed_update(bot, update)
+            rows[f"всего на обновление{' (с профилировщиком)' if profile else ''}"] = \
+                (time.perf_counter() - start) / count * 1e6
+            await asyncio.sleep(0.1)  # отправки из outbox
+        journal.close()
+    for name, stats in main.middleware_profiler.stats.items():
+        rows[name] = stats.mean_ms * 1000
+    return rows
+
+
+@benchmark("middleware")
+def bench_middleware():
+    report("Цепочка middleware update (собственное время)", asyncio.run(_middleware_timings(2000)),
+           unit="мкс/обн")
+
+
+def main(argv):
+    names = argv or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Неизвестный бенчмарк: {name}. Доступны: {', '.join(BENCHMARKS)}")
+            return 1
+        BENCHMARKS[name]()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -7,27 +7,50 @@ import os
 import logging
 import asyncio
 import json
-import time
+import heapq
 import random
+import bisect
+import time
 import ssl
-from datetime import datetime, timedelta
-from collections import defaultdict
-from typing import Dict, List, Optional, Any, Union
+import base64
+import struct
+import sys
+import threading
+import multiprocessing
+import uuid
+import zlib
+from datetime import datetime, timedelta, date as date_cls
+from array import array
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import Dict, List, Optional, Any, Union, Tuple, Callable, Set
 from dataclasses import dataclass
-from enum import Enum
+from enum import Enum, IntEnum
+
+# Отсчёт для метрики "старт процесса -> первое обработанное обновление"
+STARTED_AT = time.monotonic()
 
 import aiohttp
 import requests
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, Update
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage, MemoryStorageRecord
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramRetryAfter
 from dotenv import load_dotenv
 
+try:
+    import orjson  # необязательная зависимость: разбор ответов Google Script в несколько раз быстрее json
+except ImportError:
+    orjson = None
+
 load_dotenv()
 
 # ========== КОНФИГУРАЦИЯ ==========
@@ -39,9 +62,49 @@ class Config:
     ADMIN_IDS = [int(id.strip()) for id in os.getenv("ADMIN_IDS", "5097581039").split(",") if id.strip()]
     SESSION_TIMEOUT = 600
     CACHE_TTL = 300
+    STORAGE_DEADLINE = 20
     MAX_DATES_TO_SHOW = 6
     RATE_LIMIT_REQUESTS = 15
     RATE_LIMIT_WINDOW = 60
+    SEND_GLOBAL_RATE = 25
+    SEND_CHAT_RATE = 3
+    SEND_MAX_RETRIES = 3
+    HEALTH_CHECK_INTERVAL = 60
+    CIRCUIT_FAILURE_THRESHOLD = 5
+    CIRCUIT_RESET_TIMEOUT = 30
+    UPSTREAM_MIN_TIMEOUT = 2
+    UPSTREAM_MAX_TIMEOUT = 15
+    UPSTREAM_TIMEOUT_FACTOR = 2
+    UPSTREAM_MAX_ATTEMPTS = 3
+    UPSTREAM_BACKOFF_BASE = 0.25
+    UPSTREAM_BACKOFF_CAP = 2
+    LATENCY_WINDOW = 200
+    LATENCY_MIN_SAMPLES = 20
+    RETRY_BUDGET_RATIO = 0.1
+    RETRY_BUDGET_MIN_PER_SEC = 0.5
+    RETRY_BUDGET_MAX = 10
+    REGISTER_CONFLICT_RETRIES = 3
+    REPORT_EXECUTOR = os.getenv("REPORT_EXECUTOR", "process")
+    REPORT_TTL = 60
+    SEED_TEST_DATA = os.getenv("SEED_TEST_DATA", "False").lower() == "true"
+    REMINDERS_FILE = os.getenv("REMINDERS_FILE", "reminders.json")
+    REMINDER_OFFSETS = (24 * 3600, 2 * 3600)
+    REMINDER_BATCH_SIZE = 20
+    REMINDER_SAVE_DELAY = 5
+    WAITLIST_OFFER_TTL = 120
+    SLOT_HOLD_TTL = 180
+    SLOT_HOLD_BUCKET = 5
+    DASHBOARD_DAYS = 14
+    JOURNAL_ENABLED = os.getenv("JOURNAL_ENABLED", "False").lower() == "true"
+    JOURNAL_DIR = os.getenv("JOURNAL_DIR", "journal")
+    JOURNAL_SEGMENT_BYTES = 4 * 1024 * 1024
+    JOURNAL_KEEP_SEGMENTS = 20
+    JOURNAL_RETENTION_DAYS = int(os.getenv("JOURNAL_RETENTION_DAYS", "7"))
+    BOOKINGS_PAGE_SIZE = 5
+    STATIONS_FILE = os.getenv("STATIONS_FILE", "stations.json")
+    DEFAULT_STATION = os.getenv("DEFAULT_STATION", "main")
+    PROFILE_MIDDLEWARE = os.getenv("PROFILE_MIDDLEWARE", "False").lower() == "true"
+    COMPACT_WIRE = os.getenv("COMPACT_WIRE", "True").lower() == "true"
     DEBUG = True
 
 # ========== КОНСТАНТЫ ==========
@@ -68,28 +131,301 @@ class CallbackData(str, Enum):
     CANCEL_ASK_PREFIX = "cancel_ask_"
     CANCEL_YES_PREFIX = "cancel_yes_"
 
+BLOOD_GROUPS = ("A+", "A-", "B+", "B-", "AB+", "AB-", "O+", "O-")
+BLOOD_INDEX = {g: i for i, g in enumerate(BLOOD_GROUPS)}
+WEEKDAYS_RU = ("понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье")
+
+@lru_cache(maxsize=128)
+def describe_date(date: str) -> Dict:
+    """Подписи даты для клавиатур по ISO-дате; словарь общий для всех вызовов - не изменять"""
+    day = date_cls.fromisoformat(date)
+    weekday = WEEKDAYS_RU[day.weekday()]
+    return {
+        "date": date,
+        "day_of_week": weekday,
+        "display_date": day.strftime("%d.%m.%Y"),
+        "day_of_week_short": weekday[:3],
+        "timestamp": int(datetime(day.year, day.month, day.day).timestamp())
+    }
+
+def dump_json(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def load_json(raw: Union[bytes, str]):
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+# ========== ТАЛОНЫ ==========
+class TicketIssuer:
+    """
+    Номера талонов вида 'Т-XXXXXXXXXX': Crockford base32 от (секунды от 2024-01-01 << 16 | счётчик).
+    Номера монотонны и сортируются по времени выдачи как строки. Если за секунду выдано
+    больше 65536 талонов или часы пошли назад, issuer заимствует следующую секунду.
+    """
+    PREFIX = "Т-"
+    ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+    EPOCH = 1704067200
+    SEQ_BITS = 16
+    WIDTH = 10
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last = -1
+
+    def issue(self) -> str:
+        return self.format(self.issue_number())
+
+    def issue_number(self) -> int:
+        with self._lock:
+            value = max(int(time.time()) - self.EPOCH, 0) << self.SEQ_BITS
+            self._last = max(value, self._last + 1)
+            return self._last
+
+    def observe(self, ticket: str):
+        """Учитывает уже выданный талон (например, после восстановления), чтобы не выдать его повторно"""
+        value = self.parse(ticket)
+        if value is not None:
+            with self._lock:
+                self._last = max(self._last, value)
+
     @classmethod
-    def is_blood(cls, data: str) -> bool:
-        return data.startswith(cls.BLOOD_PREFIX)
+    def format(cls, value: int) -> str:
+        chars = []
+        for _ in range(cls.WIDTH):
+            value, digit = divmod(value, 32)
+            chars.append(cls.ALPHABET[digit])
+        return cls.PREFIX + "".join(reversed(chars))
 
     @classmethod
-    def is_date(cls, data: str) -> bool:
-        return data.startswith(cls.DATE_PREFIX)
+    def parse(cls, ticket: str) -> Optional[int]:
+        """Числовое значение талона или None для талонов другого формата"""
+        if len(ticket) != len(cls.PREFIX) + cls.WIDTH or not ticket.startswith(cls.PREFIX):
+            return None
+        value = 0
+        for char in ticket[len(cls.PREFIX):]:
+            digit = _TICKET_DIGITS.get(char)
+            if digit is None:
+                return None
+            value = value * 32 + digit
+        return value
+
+_TICKET_DIGITS = {c: i for i, c in enumerate(TicketIssuer.ALPHABET)}
+
+# ========== КОДЕК CALLBACK_DATA ==========
+class CallbackAction(IntEnum):
+    BLOOD = 1
+    DATE = 2
+    TIME = 3
+    CANCEL_ASK = 4
+    CANCEL_YES = 5
+    WAITLIST_JOIN = 6
+    WAITLIST_ACCEPT = 7
+    WAITLIST_DECLINE = 8
+    BOOKINGS_PAGE = 9
+    STATION = 10
+
+class CallbackCodec:
+    """
+    Компактный формат callback_data для кнопок с параметрами:
+    '~' + base64url(версия, код действия, полезная нагрузка).
+    Дата хранится как 2 байта (дни от 2000-01-01), время - как минуты от полуночи,
+    группа крови - как индекс в BLOOD_GROUPS, станция - как её постоянный code из stations.json.
+    Талоны TicketIssuer упаковываются в 6 байт, остальные передаются как UTF-8.
+    Кнопки версий 1 (талон всегда UTF-8) и 2 (без станции) по-прежнему читаются и относятся к станции с кодом 0.
+    """
+    MARKER = "~"
+    VERSION = 3
+    MAX_BYTES = 64
+    DATE_EPOCH = date_cls(2000, 1, 1).toordinal()
+
+    @staticmethod
+    def _pack_date(value: str) -> bytes:
+        return struct.pack(">H", date_cls.fromisoformat(value).toordinal() - CallbackCodec.DATE_EPOCH)
+
+    @staticmethod
+    def _unpack_date(raw: bytes) -> str:
+        return date_cls.fromordinal(CallbackCodec.DATE_EPOCH + struct.unpack_from(">H", raw)[0]).isoformat()
+
+    @staticmethod
+    def _pack_cursor(value: str) -> bytes:
+        """Курсор страницы записей: "дата" или "дата@код станции" - для записей разных станций на одну дату"""
+        date, sep, station = value.partition("@")
+        return CallbackCodec._pack_date(date) + (bytes((int(station),)) if sep else b"")
+
+    @staticmethod
+    def _unpack_cursor(raw: bytes) -> str:
+        date = CallbackCodec._unpack_date(raw)
+        return f"{date}@{raw[2]}" if len(raw) > 2 else date
+
+    @staticmethod
+    def _pack_time(value: str) -> bytes:
+        hours, minutes = value.split(":")
+        return struct.pack(">H", int(hours) * 60 + int(minutes))
+
+    @staticmethod
+    def _unpack_time(raw: bytes) -> str:
+        minutes = struct.unpack_from(">H", raw)[0]
+        return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+    @staticmethod
+    def _pack_ticket(value: str) -> bytes:
+        number = TicketIssuer.parse(value)
+        if number is not None:
+            return b"\x01" + number.to_bytes(6, "big")
+        return b"\x00" + value.encode("utf-8")
+
+    @staticmethod
+    def _unpack_ticket(raw: bytes) -> str:
+        if raw[0] == 1:
+            return TicketIssuer.format(int.from_bytes(raw[1:7], "big"))
+        return raw[1:].decode("utf-8")
 
     @classmethod
-    def is_time(cls, data: str) -> bool:
-        return data.startswith(cls.TIME_PREFIX)
+    def encode(cls, action: CallbackAction, *args) -> str:
+        raw = bytes((cls.VERSION, action)) + _CALLBACK_ENCODERS[action](*args)
+        data = cls.MARKER + base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+        if len(data) > cls.MAX_BYTES:
+            raise ValueError(f"callback_data длиннее {cls.MAX_BYTES} байт: {action.name}")
+        return data
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def decode(data: str) -> Optional[Tuple[CallbackAction, tuple]]:
+        """Возвращает (действие, аргументы) или None, если формат не распознан"""
+        if not data or data[0] != CallbackCodec.MARKER:
+            return None
+        body = data[1:]
+        try:
+            raw = base64.urlsafe_b64decode(body + "=" * (-len(body) % 4))
+            decoders = _CALLBACK_DECODERS_BY_VERSION.get(raw[0]) if len(raw) >= 2 else None
+            if decoders is None:
+                return None
+            action = CallbackAction(raw[1])
+            return action, decoders[action](raw[2:])
+        except (ValueError, KeyError, IndexError, struct.error):
+            return None
+
+_CALLBACK_ENCODERS = {
+    CallbackAction.BLOOD: lambda group: bytes((BLOOD_INDEX[group],)),
+    CallbackAction.DATE: CallbackCodec._pack_date,
+    CallbackAction.TIME: CallbackCodec._pack_time,
+    CallbackAction.CANCEL_ASK: lambda d, ticket, station=0: (
+        CallbackCodec._pack_date(d) + bytes((station,)) + CallbackCodec._pack_ticket(ticket)),
+    CallbackAction.CANCEL_YES: lambda d, ticket, station=0: (
+        CallbackCodec._pack_date(d) + bytes((station,)) + CallbackCodec._pack_ticket(ticket)),
+    CallbackAction.WAITLIST_JOIN: lambda d, group, station=0: CallbackCodec._pack_date(d) + bytes((BLOOD_INDEX[group], station)),
+    CallbackAction.WAITLIST_ACCEPT: lambda d, group, station=0: CallbackCodec._pack_date(d) + bytes((BLOOD_INDEX[group], station)),
+    CallbackAction.WAITLIST_DECLINE: lambda d, group, station=0: CallbackCodec._pack_date(d) + bytes((BLOOD_INDEX[group], station)),
+    CallbackAction.BOOKINGS_PAGE: lambda archived, cursor=None: (
+        bytes((int(archived),)) + (CallbackCodec._pack_cursor(cursor) if cursor else b"")),
+    CallbackAction.STATION: lambda station: bytes((station,)),
+}
+
+_CALLBACK_DECODERS = {
+    CallbackAction.BLOOD: lambda raw: (BLOOD_GROUPS[raw[0]],),
+    CallbackAction.DATE: lambda raw: (CallbackCodec._unpack_date(raw),),
+    CallbackAction.TIME: lambda raw: (CallbackCodec._unpack_time(raw),),
+    CallbackAction.CANCEL_ASK: lambda raw: (
+        CallbackCodec._unpack_date(raw), CallbackCodec._unpack_ticket(raw[3:]), raw[2]),
+    CallbackAction.CANCEL_YES: lambda raw: (
+        CallbackCodec._unpack_date(raw), CallbackCodec._unpack_ticket(raw[3:]), raw[2]),
+    CallbackAction.WAITLIST_JOIN: lambda raw: (CallbackCodec._unpack_date(raw), BLOOD_GROUPS[raw[2]], raw[3]),
+    CallbackAction.WAITLIST_ACCEPT: lambda raw: (CallbackCodec._unpack_date(raw), BLOOD_GROUPS[raw[2]], raw[3]),
+    CallbackAction.WAITLIST_DECLINE: lambda raw: (CallbackCodec._unpack_date(raw), BLOOD_GROUPS[raw[2]], raw[3]),
+    CallbackAction.BOOKINGS_PAGE: lambda raw: (bool(raw[0]), CallbackCodec._unpack_cursor(raw[1:]) if len(raw) > 1 else None),
+    CallbackAction.STATION: lambda raw: (raw[0],),
+}
+
+_CALLBACK_DECODERS_V2 = {
+    **_CALLBACK_DECODERS,
+    CallbackAction.CANCEL_ASK: lambda raw: (CallbackCodec._unpack_date(raw), CallbackCodec._unpack_ticket(raw[2:]), 0),
+    CallbackAction.CANCEL_YES: lambda raw: (CallbackCodec._unpack_date(raw), CallbackCodec._unpack_ticket(raw[2:]), 0),
+    CallbackAction.WAITLIST_JOIN: lambda raw: (CallbackCodec._unpack_date(raw), BLOOD_GROUPS[raw[2]], 0),
+    CallbackAction.WAITLIST_ACCEPT: lambda raw: (CallbackCodec._unpack_date(raw), BLOOD_GROUPS[raw[2]], 0),
+    CallbackAction.WAITLIST_DECLINE: lambda raw: (CallbackCodec._unpack_date(raw), BLOOD_GROUPS[raw[2]], 0),
+}
+
+_CALLBACK_DECODERS_V1 = {
+    **_CALLBACK_DECODERS_V2,
+    CallbackAction.CANCEL_ASK: lambda raw: (CallbackCodec._unpack_date(raw), raw[2:].decode("utf-8"), 0),
+    CallbackAction.CANCEL_YES: lambda raw: (CallbackCodec._unpack_date(raw), raw[2:].decode("utf-8"), 0),
+}
+
+_CALLBACK_DECODERS_BY_VERSION = {1: _CALLBACK_DECODERS_V1, 2: _CALLBACK_DECODERS_V2, CallbackCodec.VERSION: _CALLBACK_DECODERS}
+
+def decode_callback(data: str, action: CallbackAction) -> Optional[tuple]:
+    """Аргументы callback_data, если она закодирована для указанного действия"""
+    decoded = CallbackCodec.decode(data)
+    if decoded and decoded[0] == action:
+        return decoded[1]
+    return None
+
+def is_cancel_callback(callback: CallbackQuery) -> bool:
+    """Фильтр для обработчика отмены записей"""
+    data = callback.data or ""
+    if data.startswith("cancel_"):
+        return True
+    decoded = CallbackCodec.decode(data)
+    return bool(decoded) and decoded[0] in (CallbackAction.CANCEL_ASK, CallbackAction.CANCEL_YES)
+
+def is_waitlist_callback(callback: CallbackQuery) -> bool:
+    decoded = CallbackCodec.decode(callback.data or "")
+    return bool(decoded) and decoded[0] in (
+        CallbackAction.WAITLIST_JOIN, CallbackAction.WAITLIST_ACCEPT, CallbackAction.WAITLIST_DECLINE
+    )
+
+def is_bookings_page_callback(callback: CallbackQuery) -> bool:
+    return decode_callback(callback.data or "", CallbackAction.BOOKINGS_PAGE) is not None
 
 # ========== МОДЕЛИ ==========
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Booking:
-    ticket: str
-    date: str
-    time: str
-    blood_group: str
-    day: str
+    """
+    Компактная запись: талон - число TicketIssuer, дата - ординал, время - минуты от полуночи,
+    группа крови - индекс в BLOOD_GROUPS, created_at - unix-время. Строковые поля вычисляются по запросу.
+    """
+    ticket_number: int
+    date_ordinal: int
+    minute: int
+    blood_index: int
     user_id: int
-    created_at: Optional[str] = None
+    created_at: int = 0
+
+    @classmethod
+    def create(cls, ticket_number: int, date: str, time_slot: str, blood_group: str, user_id: int,
+               created_at: Optional[int] = None) -> "Booking":
+        hours, minutes = time_slot.split(":")
+        return cls(ticket_number, date_cls.fromisoformat(date).toordinal(), int(hours) * 60 + int(minutes),
+                   BLOOD_INDEX[blood_group], user_id, int(time.time()) if created_at is None else created_at)
+
+    @property
+    def ticket(self) -> str:
+        return TicketIssuer.format(self.ticket_number)
+
+    @property
+    def date(self) -> str:
+        return _format_ordinal(self.date_ordinal)
+
+    @property
+    def time(self) -> str:
+        return _format_minute(self.minute)
+
+    @property
+    def blood_group(self) -> str:
+        return BLOOD_GROUPS[self.blood_index]
+
+    @property
+    def day(self) -> str:
+        return WEEKDAYS_RU[(self.date_ordinal + 6) % 7]
+
+@lru_cache(maxsize=1024)
+def _format_ordinal(ordinal: int) -> str:
+    return sys.intern(date_cls.fromordinal(ordinal).isoformat())
+
+@lru_cache(maxsize=1440)
+def _format_minute(minute: int) -> str:
+    return sys.intern(f"{minute // 60:02d}:{minute % 60:02d}")
 
 @dataclass
 class ApiResponse:
@@ -104,15 +440,215 @@ class ApiResponse:
     def error(cls, message: str):
         return cls(status="error", data=message)
 
+    @classmethod
+    def conflict(cls, data: Dict):
+        """Запись отклонена: версия слота изменилась; data - свежий ответ get_free_times"""
+        return cls(status="conflict", data=data)
+
 # ========== КЛИЕНТ GOOGLE SCRIPT ==========
+class LatencyStats:
+    """
+    Задержка одного действия upstream: счётчики и скользящее среднее, O(1) на запрос.
+    Последние window замеров хранятся для перцентилей; сортируются только при запросе перцентиля.
+    Пишется из потоков call_api, читается из event loop - под блокировкой.
+    """
+    __slots__ = ("count", "errors", "ewma_ms", "max_ms", "total_ms", "samples", "_lock")
+    ALPHA = 0.2
+
+    def __init__(self, window: int = Config.LATENCY_WINDOW):
+        self.count = 0
+        self.errors = 0
+        self.ewma_ms = 0.0
+        self.max_ms = 0.0
+        self.total_ms = 0.0
+        self.samples: deque = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    @property
+    def mean_ms(self) -> float:
+        return self.total_ms / self.count if self.count else 0.0
+
+    def percentile(self, p: float) -> float:
+        with self._lock:
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))] if ordered else 0.0
+
+    def record(self, ms: float, ok: bool = True):
+        with self._lock:
+            self.ewma_ms = ms if not self.count else self.ewma_ms + self.ALPHA * (ms - self.ewma_ms)
+            self.max_ms = max(self.max_ms, ms)
+            self.total_ms += ms
+            self.samples.append(ms)
+            self.count += 1
+            if not ok:
+                self.errors += 1
+
+class RetryBudget:
+    """
+    Общий на процесс лимит повторов: каждый запрос пополняет бюджет на ratio, повтор тратит 1.
+    Плюс min_per_sec повторов в секунду при малом трафике. Во время сбоя повторы быстро
+    упираются в бюджет и не умножают нагрузку на upstream.
+    """
+    def __init__(self, ratio: float = Config.RETRY_BUDGET_RATIO,
+                 min_per_sec: float = Config.RETRY_BUDGET_MIN_PER_SEC, limit: float = Config.RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self.min_per_sec = min_per_sec
+        self.limit = limit
+        self.tokens = limit
+        self.updated = time.monotonic()
+        self.retries = 0
+        self.denied = 0
+        # call_api выполняется в потоках asyncio.to_thread
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.limit, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.min_per_sec)
+            self.updated = now
+            if self.tokens < 1:
+                self.denied += 1
+                return False
+            self.tokens -= 1
+            self.retries += 1
+            return True
+
+retry_budget = RetryBudget()
+
+class CircuitBreaker:
+    """
+    Состояние upstream: closed - работает, open - недоступен и запросы не отправляются,
+    half_open - после reset_timeout пропускаем запросы, первый результат решает, закрыться или снова открыться.
+    Переходы выполняются под блокировкой: call_api работает в потоках asyncio.to_thread.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = Config.CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = Config.CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.last_error: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            return self.state != self.OPEN
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                print("[CIRCUIT] Google Script снова доступен")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.last_error = None
+
+    def record_failure(self, error: str):
+        with self._lock:
+            self.failures += 1
+            self.last_error = error
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                print(f"[CIRCUIT] Google Script недоступен: {error}")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+class WireCodec:
+    """
+    Компактный формат ответов Google Script. Клиент добавляет в запрос "wire": VERSION; скрипт, знающий формат,
+    отвечает {"status", "wire": VERSION, "data"} в сжатом виде. Старый скрипт поле игнорирует и отвечает как
+    раньше, поэтому expand вызывается только для ответов с "wire".
+      get_available_dates: {"d": ["2026-10-20", ...]} - день недели и подписи вычисляются на стороне бота
+      get_free_times: {"t": [индексы в рабочих часах], "q": [осталось, всего, занято], "v": версия,
+                       "h": [рабочие часы]}
+    Рабочие часы "h" скрипт присылает, только если их отпечаток не совпал с "hours" из запроса.
+    """
+    VERSION = 1
+
+    def __init__(self):
+        # (отпечаток, часы) - одной парой, чтобы потоки call_api не видели отпечаток от других часов
+        self.hours: Tuple[str, List[str]] = ("", [])
+
+    @staticmethod
+    def fingerprint(hours: List[str]) -> str:
+        return format(zlib.crc32(",".join(hours).encode("utf-8")), "08x")
+
+    def request_fields(self, action: str) -> Dict:
+        if action == "get_available_dates":
+            return {"wire": self.VERSION}
+        if action == "get_free_times":
+            return {"wire": self.VERSION, "hours": self.hours[0]}
+        return {}
+
+    def expand(self, action: str, data: Dict) -> Dict:
+        if action == "get_available_dates":
+            dates = [describe_date(d) for d in data.get("d", [])]
+            return {"available_dates": dates, "count": len(dates)}
+        if action == "get_free_times":
+            if "h" in data:
+                self.hours = (self.fingerprint(data["h"]), data["h"])
+            hours = self.hours[1]
+            left, total, used = data["q"]
+            expanded = {"times": [hours[i] for i in data.get("t", [])],
+                        "quota": left, "quota_total": total, "quota_used": used}
+            if "v" in data:
+                expanded["version"] = data["v"]
+            return expanded
+        return data
+
+    @classmethod
+    def compact(cls, action: str, data: Dict, hours: List[str], hours_tag: str = "") -> Dict:
+        """Сжатие полного ответа так, как это делает скрипт: эталон для его реализации и для бенчмарка"""
+        if action == "get_available_dates":
+            return {"d": [d["date"] for d in data["available_dates"]]}
+        if action == "get_free_times":
+            index = {t: i for i, t in enumerate(hours)}
+            compacted = {"t": [index[t] for t in data["times"]],
+                         "q": [data["quota"], data["quota_total"], data["quota_used"]]}
+            if "version" in data:
+                compacted["v"] = data["version"]
+            if hours_tag != cls.fingerprint(hours):
+                compacted["h"] = hours
+            return compacted
+        return data
+
 class GoogleScriptClient:
-    def __init__(self, script_url: str):
+    # Ответы этих действий не зависят от записей других пользователей и кэшируются на CACHE_TTL
+    CACHEABLE_ACTIONS = {"get_available_dates"}
+    # Изменяющие действия повторяются при тех же сбоях, что и чтения (в т.ч. таймаут и 5xx, когда запись
+    # могла пройти): ключ idempotency_key один на все попытки, и скрипт по нему возвращает уже созданную
+    # запись вместо второй
+    WRITE_ACTIONS = {"register", "cancel_booking"}
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    # Accept-Encoding: gzip requests добавляет сам и распаковывает ответ прозрачно
+    HEADERS = {"Content-Type": "application/json"}
+
+    def __init__(self, script_url: str, cache_ttl: int = Config.CACHE_TTL, budget: RetryBudget = retry_budget):
         self.script_url = script_url
-        self.timeout = 15
-        self.cache = {}
+        self.timeout = Config.UPSTREAM_MAX_TIMEOUT
+        self.cache_ttl = cache_ttl
+        self.cache: Dict[str, Tuple[float, ApiResponse]] = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.latency: Dict[str, LatencyStats] = {}
+        # Кэш, счётчики и словарь задержек меняются из потоков asyncio.to_thread
+        self._lock = threading.Lock()
         self.session = requests.Session()
+        self.circuit = CircuitBreaker()
+        self.budget = budget
+        self.wire = WireCodec()
 
     def test_connection(self) -> ApiResponse:
+        """Проверка доступности; результат всегда обновляет состояние circuit"""
         try:
             response = self.session.post(
                 self.script_url,
@@ -120,11 +656,46 @@ class GoogleScriptClient:
                 timeout=self.timeout
             )
             if response.status_code == 200:
+                self.circuit.record_success()
                 return ApiResponse.success(response.json())
+            self.circuit.record_failure(f"HTTP ошибка: {response.status_code}")
             return ApiResponse.error(f"HTTP ошибка: {response.status_code}")
         except Exception as e:
+            self.circuit.record_failure(str(e))
             return ApiResponse.error(str(e))
 
+    def timeout_for(self, action: str) -> float:
+        """p99 задержки действия с запасом; пока замеров мало - максимальный таймаут"""
+        stats = self.latency.get(action)
+        if stats is None or len(stats.samples) < Config.LATENCY_MIN_SAMPLES:
+            return self.timeout
+        p99 = stats.percentile(0.99) / 1000 * Config.UPSTREAM_TIMEOUT_FACTOR
+        return min(self.timeout, max(Config.UPSTREAM_MIN_TIMEOUT, p99))
+
+    def _post(self, action: str, payload: Dict, deadline: float):
+        """Одна попытка: (ответ, None) или (None, исключение requests); здесь учитывается задержка"""
+        with self._lock:
+            stats = self.latency.setdefault(action, LatencyStats())
+        timeout = min(self.timeout_for(action), max(0.1, deadline - time.monotonic()))
+        started = time.perf_counter()
+        try:
+            response = self.session.post(
+                self.script_url,
+                data=dump_json(payload),
+                headers=self.HEADERS,
+                timeout=timeout
+            )
+        except requests.RequestException as e:
+            stats.record((time.perf_counter() - started) * 1000, ok=False)
+            return None, e
+        stats.record((time.perf_counter() - started) * 1000, ok=response.status_code == 200)
+        return response, None
+
+    def _retryable(self, response, error: Optional[Exception]) -> bool:
+        if error is not None:
+            return isinstance(error, (requests.Timeout, requests.ConnectionError))
+        return response.status_code in self.RETRY_STATUSES
+
     def call_api(self, action: str, data: Dict = None, user_id: int = None,
                  force_refresh: bool = False) -> ApiResponse:
         if data is None:
@@ -135,45 +706,100 @@ class GoogleScriptClient:
             if user_id:
                 payload["user_id"] = str(user_id)
 
-            response = self.session.post(
-                self.script_url,
-                json=payload,
-                timeout=self.timeout
-            )
-
+            cache_key = None
+            if action in self.CACHEABLE_ACTIONS:
+                cache_key = json.dumps(payload, sort_keys=True)
+                with self._lock:
+                    cached = self.cache.get(cache_key)
+                    if cached and not force_refresh and time.monotonic() - cached[0] < self.cache_ttl:
+                        self.cache_hits += 1
+                        return cached[1]
+                    self.cache_misses += 1
+
+            if action in self.WRITE_ACTIONS:
+                payload["idempotency_key"] = uuid.uuid4().hex
+            if Config.COMPACT_WIRE:
+                payload.update(self.wire.request_fields(action))
+
+            # Повторы укладываются в тот же дедлайн, что и ожидание в StorageAdapter.gather
+            deadline = time.monotonic() + Config.STORAGE_DEADLINE
+            self.budget.deposit()
+            attempt = 1
+            while True:
+                if not self.circuit.allow_request():
+                    return ApiResponse.error("Сервис временно недоступен")
+                response, error = self._post(action, payload, deadline)
+                if not self._retryable(response, error) or attempt >= Config.UPSTREAM_MAX_ATTEMPTS:
+                    break
+                # Полный jitter: одновременные повторы разных пользователей не приходят пачкой
+                delay = random.uniform(0, min(Config.UPSTREAM_BACKOFF_CAP, Config.UPSTREAM_BACKOFF_BASE * 2 ** attempt))
+                if time.monotonic() + delay >= deadline or not self.budget.withdraw():
+                    break
+                print(f"[RETRY] {action}: попытка {attempt + 1} через {delay:.2f} с "
+                      f"({error or f'HTTP {response.status_code}'})")
+                time.sleep(delay)
+                attempt += 1
+
+            # Один вызов - один отказ для circuit, сколько бы попыток ни было
+            if error is not None:
+                self.circuit.record_failure(str(error))
+                raise error
             if response.status_code != 200:
+                self.circuit.record_failure(f"HTTP ошибка: {response.status_code}")
                 return ApiResponse.error(f"HTTP ошибка: {response.status_code}")
 
-            result = response.json()
+            self.circuit.record_success()
+            result = load_json(response.content)
+            if result.get("status") == "conflict":
+                return ApiResponse.conflict(result.get("data", {}))
             if result.get("status") == "success":
-                return ApiResponse.success(result.get("data", {}))
+                data = result.get("data", {})
+                if result.get("wire"):
+                    data = self.wire.expand(action, data)
+                api_response = ApiResponse.success(data)
+                if cache_key:
+                    with self._lock:
+                        self.cache[cache_key] = (time.monotonic(), api_response)
+                return api_response
             return ApiResponse.error(result.get("data", "Неизвестная ошибка"))
 
         except Exception as e:
             return ApiResponse.error(str(e))
 
     def clear_cache(self):
-        self.cache.clear()
+        with self._lock:
+            self.cache.clear()
+
+    def latency_items(self) -> List[Tuple[str, LatencyStats]]:
+        with self._lock:
+            return sorted(self.latency.items())
 
 # ========== ЛОКАЛЬНОЕ ХРАНИЛИЩЕ ==========
 class LocalStorage:
-    def __init__(self):
+    def __init__(self, seed_test_data: bool = Config.SEED_TEST_DATA, quotas: Optional[Dict] = None,
+                 working_hours: Optional[List[str]] = None, ticket_issuer: Optional[TicketIssuer] = None):
         self._lock = asyncio.Lock()
         self.bookings: Dict[int, Dict[str, Booking]] = {}
-        self.working_hours = [
+        self.tickets: Dict[int, Booking] = {}
+        # Ординалы дат записей пользователя по возрастанию - для постраничного вывода
+        self.user_dates: Dict[int, List[int]] = {}
+        # Версия (дата, группа крови) растёт при каждой записи и отмене; не сбрасывается, даже при очистке
+        self.versions: Dict[Tuple[str, str], int] = {}
+        self.ticket_issuer = ticket_issuer or TicketIssuer()
+        self.working_hours = working_hours or [
             "07:30", "08:00", "08:30", "09:00", "09:30", "10:00",
             "10:30", "11:00", "11:30", "12:00", "12:30", "13:00", "13:30", "14:00"
         ]
-        self.quotas = self._get_default_quotas()
-        self._add_test_data()
+        self.quotas = quotas or self._get_default_quotas()
+        if seed_test_data:
+            self._add_test_data()
         print("[LOCAL] Локальное хранилище инициализировано")
 
     def _get_default_quotas(self):
         base = {"A+": 10, "A-": 5, "B+": 10, "B-": 5, "AB+": 5, "AB-": 3, "O+": 10, "O-": 5}
         weekend = {"A+": 8, "A-": 4, "B+": 8, "B-": 4, "AB+": 3, "AB-": 2, "O+": 8, "O-": 4}
-        days = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
         quotas = {}
-        for day in days:
+        for day in WEEKDAYS_RU:
             quotas[day] = weekend.copy() if day in ["суббота", "воскресенье"] else base.copy()
         return quotas
 
@@ -184,22 +810,51 @@ class LocalStorage:
             (222222, today + timedelta(days=2), "10:30", "B-"),
         ]
         for user_id, date, time_slot, blood_group in test_data:
-            date_str = date.strftime("%Y-%m-%d")
-            day = self._get_day_of_week_ru(date)
-            self._add_booking_sync(user_id, date_str, time_slot, blood_group, day)
+            self._add_booking_sync(user_id, date.strftime("%Y-%m-%d"), time_slot, blood_group)
         print(f"[LOCAL] Добавлено тестовых записей: {len(test_data)}")
 
-    def _add_booking_sync(self, user_id, date, time_slot, blood_group, day):
-        ticket = f"Т-{day[:3]}-{blood_group}-{random.randint(1000, 9999)}"
-        booking = Booking(ticket, date, time_slot, blood_group, day, user_id, datetime.now().isoformat())
+    def _add_booking_sync(self, user_id, date, time_slot, blood_group):
+        booking = Booking.create(self.ticket_issuer.issue_number(), date, time_slot, blood_group, user_id)
+        return self._insert_booking_sync(booking)
+
+    def _insert_booking_sync(self, booking: Booking) -> Booking:
+        user_id = booking.user_id
+        # Ключи-даты повторяются у тысяч пользователей - храним одну копию строки
+        date = booking.date
         if user_id not in self.bookings:
             self.bookings[user_id] = {}
+        replaced = self.bookings[user_id].get(date)
+        if replaced:
+            self.tickets.pop(replaced.ticket_number, None)
+            self._bump_version(replaced)
+        else:
+            bisect.insort(self.user_dates.setdefault(user_id, []), booking.date_ordinal)
         self.bookings[user_id][date] = booking
+        self.tickets[booking.ticket_number] = booking
+        self._bump_version(booking)
         return booking
 
+    def _bump_version(self, booking: Booking):
+        key = (booking.date, booking.blood_group)
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def _remove_booking_sync(self, booking: Booking):
+        self._bump_version(booking)
+        del self.tickets[booking.ticket_number]
+        del self.bookings[booking.user_id][booking.date]
+        dates = self.user_dates[booking.user_id]
+        del dates[bisect.bisect_left(dates, booking.date_ordinal)]
+        if not self.bookings[booking.user_id]:
+            del self.bookings[booking.user_id]
+            del self.user_dates[booking.user_id]
+
+    def _clear_sync(self):
+        self.bookings.clear()
+        self.tickets.clear()
+        self.user_dates.clear()
+
     def _get_day_of_week_ru(self, date_obj):
-        days = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
-        return days[date_obj.weekday()]
+        return WEEKDAYS_RU[date_obj.weekday()]
 
     def get_available_dates(self, user_id: int) -> ApiResponse:
         today = datetime.now()
@@ -211,13 +866,7 @@ class LocalStorage:
             day_of_week = self._get_day_of_week_ru(check_date)
             if day_of_week in self.quotas:
                 if any(q > 0 for q in self.quotas[day_of_week].values()):
-                    available_dates.append({
-                        "date": check_date.strftime("%Y-%m-%d"),
-                        "day_of_week": day_of_week,
-                        "display_date": check_date.strftime("%d.%m.%Y"),
-                        "day_of_week_short": day_of_week[:3],
-                        "timestamp": int(check_date.timestamp())
-                    })
+                    available_dates.append(describe_date(check_date.strftime("%Y-%m-%d")))
         return ApiResponse.success({"available_dates": available_dates, "count": len(available_dates)})
 
     def get_free_times(self, date: str, blood_group: str) -> ApiResponse:
@@ -228,13 +877,15 @@ class LocalStorage:
             for user_data in self.bookings.values():
                 if date in user_data and user_data[date].blood_group == blood_group:
                     busy_times.append(user_data[date].time)
-            free_times = [t for t in self.working_hours if t not in busy_times]
             total_quota = self.quotas[day_of_week].get(blood_group, 0)
+            # Когда квота исчерпана, свободных слотов для этой группы нет, даже если часы не заняты
+            free_times = [t for t in self.working_hours if t not in busy_times] if len(busy_times) < total_quota else []
             return ApiResponse.success({
                 "times": free_times,
                 "quota": max(0, total_quota - len(busy_times)),
                 "quota_total": total_quota,
-                "quota_used": len(busy_times)
+                "quota_used": len(busy_times),
+                "version": self.versions.get((date, blood_group), 0)
             })
         except Exception as e:
             return ApiResponse.error(str(e))
@@ -249,16 +900,25 @@ class LocalStorage:
                 })
             return ApiResponse.success({"exists": False})
 
-    async def register(self, date: str, blood_group: str, time_slot: str, user_id: int) -> ApiResponse:
+    async def register(self, date: str, blood_group: str, time_slot: str, user_id: int,
+                       reserved: int = 0, expected_version: Optional[int] = None) -> ApiResponse:
+        """
+        reserved - места, удержанные другими донорами на время выбора.
+        expected_version - версия слота из прочитанного get_free_times; если с тех пор были записи или отмены,
+        возвращается ApiResponse.conflict со свежим состоянием - так же отвечает Google Script.
+        """
         async with self._lock:
             try:
                 date_obj = datetime.strptime(date, "%Y-%m-%d")
                 day_of_week = self._get_day_of_week_ru(date_obj)
 
-                existing = await self.check_existing(date, user_id)
-                if existing.data.get("exists"):
+                # check_existing берёт тот же (нереентерабельный) lock - проверяем напрямую
+                if date in self.bookings.get(user_id, {}):
                     return ApiResponse.error("У вас уже есть запись на эту дату")
 
+                if expected_version is not None and expected_version != self.versions.get((date, blood_group), 0):
+                    return ApiResponse.conflict(self.get_free_times(date, blood_group).data)
+
                 for u in self.bookings.values():
                     if date in u and u[date].time == time_slot and u[date].blood_group == blood_group:
                         return ApiResponse.error("Время уже занято")
@@ -267,83 +927,278 @@ class LocalStorage:
                 used = sum(1 for u in self.bookings.values()
                           if date in u and u[date].blood_group == blood_group)
 
-                if used >= total:
+                if used + reserved >= total:
                     return ApiResponse.error("Все квоты заняты")
 
-                booking = self._add_booking_sync(user_id, date, time_slot, blood_group, day_of_week)
+                booking = self._add_booking_sync(user_id, date, time_slot, blood_group)
                 return ApiResponse.success({
                     "ticket": booking.ticket, "day": booking.day, "date": booking.date,
                     "time": booking.time, "blood_group": booking.blood_group,
-                    "quota_remaining": total - used - 1
+                    "quota_remaining": total - used - reserved - 1,
+                    "version": self.versions[(date, blood_group)]
                 })
             except Exception as e:
                 return ApiResponse.error(str(e))
 
-    async def cancel_booking(self, date: str, ticket: str, user_id: int) -> ApiResponse:
+    async def cancel_booking(self, date: Optional[str], ticket: str, user_id: int) -> ApiResponse:
+        """Отмена по талону; дата необязательна и только дополнительно сверяется"""
         async with self._lock:
-            if user_id in self.bookings and date in self.bookings[user_id]:
-                if self.bookings[user_id][date].ticket == ticket:
-                    del self.bookings[user_id][date]
-                    if not self.bookings[user_id]:
-                        del self.bookings[user_id]
-                    return ApiResponse.success({"message": "Запись отменена"})
+            b = self.tickets.get(TicketIssuer.parse(ticket))
+            if b and b.user_id == user_id and (date is None or b.date == date):
+                self._remove_booking_sync(b)
+                return ApiResponse.success({"message": "Запись отменена", "date": b.date,
+                                            "time": b.time, "blood_group": b.blood_group,
+                                            "version": self.versions[(b.date, b.blood_group)]})
             return ApiResponse.error("Запись не найдена")
 
-    def get_user_bookings(self, user_id: int) -> ApiResponse:
-        if user_id in self.bookings:
-            bookings = [{"date": d, "day": b.day, "ticket": b.ticket,
-                        "time": b.time, "blood_group": b.blood_group}
-                       for d, b in self.bookings[user_id].items()]
-            return ApiResponse.success({"bookings": bookings, "count": len(bookings)})
-        return ApiResponse.success({"bookings": [], "count": 0})
-
-    def get_stats(self) -> ApiResponse:
-        total_bookings = sum(len(u) for u in self.bookings.values())
-        total_users = len(self.bookings)
-        day_stats = {}
-        blood_stats = {}
-
-        for user_data in self.bookings.values():
-            for b in user_data.values():
-                day_stats[b.day] = day_stats.get(b.day, 0) + 1
-                blood_stats[b.blood_group] = blood_stats.get(b.blood_group, 0) + 1
+    def get_user_bookings(self, user_id: int, archived: bool = False, cursor: Optional[str] = None,
+                          limit: int = Config.BOOKINGS_PAGE_SIZE) -> ApiResponse:
+        """
+        Страница записей: предстоящие (с сегодняшнего дня) по возрастанию даты или архив по убыванию.
+        cursor - дата первой записи страницы (next_cursor предыдущей); стоимость O(log n + limit).
+        """
+        dates = self.user_dates.get(user_id, [])
+        today = date_cls.today().toordinal()
+        split = bisect.bisect_left(dates, today)
+        position = date_cls.fromisoformat(cursor).toordinal() if cursor else None
+        if archived:
+            end = bisect.bisect_right(dates, position, 0, split) if position is not None else split
+            page = dates[max(0, end - limit):end][::-1]
+            next_ordinal = dates[end - limit - 1] if end - limit > 0 else None
+        else:
+            start = bisect.bisect_left(dates, position, split) if position is not None else split
+            page = dates[start:start + limit]
+            next_ordinal = dates[start + limit] if start + limit < len(dates) else None
+
+        user_bookings = self.bookings.get(user_id, {})
+        bookings = []
+        for ordinal in page:
+            b = user_bookings[_format_ordinal(ordinal)]
+            bookings.append({"date": b.date, "day": b.day, "ticket": b.ticket,
+                             "time": b.time, "blood_group": b.blood_group})
+        return ApiResponse.success({
+            "bookings": bookings, "count": len(bookings),
+            "upcoming_count": len(dates) - split, "archived_count": split,
+            "next_cursor": _format_ordinal(next_ordinal) if next_ordinal is not None else None,
+        })
 
-        most_popular_day = "нет данных"
-        most_popular_blood = "нет данных"
+    def snapshot(self) -> List[Booking]:
+        """Срез записей на текущий момент; Booking неизменяемы, поэтому срез можно обрабатывать в другом потоке"""
+        return list(self.tickets.values())
 
-        if day_stats:
-            most_popular_day = max(day_stats.items(), key=lambda x: x[1])[0]
-        if blood_stats:
-            most_popular_blood = max(blood_stats.items(), key=lambda x: x[1])[0]
+    def get_stats(self) -> ApiResponse:
+        """Синхронный расчёт в текущем потоке; бот считает статистику через reports, вне event loop"""
+        return ApiResponse.success(compute_stats(*stats_columns(self.snapshot())))
+
+def paginate_bookings(bookings: List[Dict], archived: bool, cursor: Optional[str], limit: int) -> Dict:
+    """Та же страница, что у LocalStorage.get_user_bookings, по полному списку записей (ISO-даты)"""
+    today = date_cls.today().isoformat()
+    upcoming = sorted((b for b in bookings if b["date"] >= today), key=lambda b: b["date"])
+    history = sorted((b for b in bookings if b["date"] < today), key=lambda b: b["date"], reverse=True)
+    section = history if archived else upcoming
+    if cursor:
+        section = [b for b in section if (b["date"] <= cursor if archived else b["date"] >= cursor)]
+    return {
+        "bookings": section[:limit], "count": len(section[:limit]),
+        "upcoming_count": len(upcoming), "archived_count": len(history),
+        "next_cursor": section[limit]["date"] if len(section) > limit else None,
+    }
+
+# ========== УДЕРЖАНИЕ МЕСТ ==========
+class SlotHolds:
+    """
+    Временное удержание места в квоте (дата, группа крови), пока донор выбирает время.
+    У донора не больше одного удержания. Сроки разложены по корзинам шириной bucket секунд:
+    при каждом обращении и по таймеру корзины (один на корзину, не на удержание) снимаются только
+    целиком истёкшие корзины, без обхода всех удержаний, поэтому удержание может прожить до bucket секунд
+    дольше ttl. Место, освобождённое без записи, сообщается в on_release - его ждёт лист ожидания.
+    """
+    def __init__(self, ttl: float = Config.SLOT_HOLD_TTL, bucket: float = Config.SLOT_HOLD_BUCKET):
+        self.ttl = ttl
+        self.bucket = bucket
+        self.holds: Dict[Tuple[str, str], Dict[int, float]] = {}
+        self.by_user: Dict[int, Tuple[str, str]] = {}
+        self.buckets: Dict[int, List[Tuple[int, Tuple[str, str]]]] = {}
+        self.bucket_heap: List[int] = []
+        # Остаток квоты по последнему ответу backend - для отказа без запроса, когда всё удержано
+        self.last_quota: Dict[Tuple[str, str], int] = {}
+        self.on_release: Optional[Callable[[int, Tuple[str, str]], None]] = None
+
+    def hold(self, date: str, blood_group: str, user_id: int, ttl: Optional[float] = None):
+        now = time.monotonic()
+        self._expire(now)
+        key = (date, blood_group)
+        if self.by_user.get(user_id, key) != key:
+            self.release(user_id)
+        expires = now + (self.ttl if ttl is None else ttl)
+        self.holds.setdefault(key, {})[user_id] = expires
+        self.by_user[user_id] = key
+        bucket_id = int(expires // self.bucket)
+        if bucket_id not in self.buckets:
+            self.buckets[bucket_id] = []
+            heapq.heappush(self.bucket_heap, bucket_id)
+            # Без таймера истёкшее удержание снялось бы только при следующем обращении к этой станции
+            asyncio.get_running_loop().call_later(
+                (bucket_id + 1) * self.bucket - now + 0.01, lambda: self._expire(time.monotonic()))
+        self.buckets[bucket_id].append((user_id, key))
+
+    def release(self, user_id: int, key: Optional[Tuple[str, str]] = None, notify: bool = True) -> bool:
+        """
+        Снимает удержание донора; с key - только если удерживается именно это место.
+        notify=False - место занято записью самого донора и в квоту не возвращается.
+        """
+        if key is not None and self.by_user.get(user_id) != key:
+            return False
+        key = self.by_user.pop(user_id, None)
+        if key is None:
+            return False
+        users = self.holds.get(key)
+        if users is not None:
+            users.pop(user_id, None)
+            if not users:
+                del self.holds[key]
+        if notify and self.on_release:
+            self.on_release(user_id, key)
+        return True
 
-        return ApiResponse.success({
-            "total_bookings": total_bookings,
-            "total_users": total_users,
-            "day_stats": day_stats,
-            "blood_group_stats": blood_stats,
-            "most_popular_day": most_popular_day,
-            "most_popular_blood_group": most_popular_blood
-        })
+    def held_by_others(self, date: str, blood_group: str, user_id: Optional[int] = None) -> int:
+        self._expire(time.monotonic())
+        users = self.holds.get((date, blood_group))
+        if not users:
+            return 0
+        return len(users) - (user_id in users)
+
+    def apply(self, date: str, blood_group: str, data: Dict, user_id: Optional[int]) -> Dict:
+        """Ответ get_free_times с учётом мест, удержанных другими донорами"""
+        quota = data.get("quota", 0)
+        self.last_quota[(date, blood_group)] = quota
+        others = self.held_by_others(date, blood_group, user_id)
+        if not others:
+            return data
+        quota = max(0, quota - others)
+        return {**data, "quota": quota, "times": data.get("times", []) if quota else [], "quota_held": others}
+
+    def _expire(self, now: float):
+        current = int(now // self.bucket)
+        while self.bucket_heap and self.bucket_heap[0] < current:
+            for user_id, key in self.buckets.pop(heapq.heappop(self.bucket_heap)):
+                users = self.holds.get(key)
+                # Удержание могли продлить или перенести - снимаем только если срок действительно вышел
+                if users and user_id in users and users[user_id] <= now:
+                    self.release(user_id)
 
 # ========== АДАПТЕР ==========
 class StorageAdapter:
-    def __init__(self, mode: str, google: GoogleScriptClient, local: LocalStorage):
+    def __init__(self, mode: str, google: GoogleScriptClient, local: LocalStorage,
+                 station: str = Config.DEFAULT_STATION):
         self.mode = mode
+        self.station = station
         self.google = google
         self.local = local
+        self.holds = SlotHolds()
+        self.holds.on_release = self._hold_released
+        self.listeners: List[Callable[[str, Dict], None]] = []
+        # Чтения в полёте по ключу (действие, аргументы); ссылка в словаре не даёт GC собрать задачу
+        self.inflight: Dict[Tuple, asyncio.Task] = {}
+
+    def subscribe(self, listener: Callable[[str, Dict], None]):
+        """
+        listener(event, payload) вызывается после успешных изменений (booked, cancelled)
+        и после каждого успешного чтения свободного времени (free_times)
+        """
+        self.listeners.append(listener)
+
+    def _hold_released(self, user_id: int, key: Tuple[str, str]):
+        self._notify("released", {"date": key[0], "blood_group": key[1], "user_id": user_id})
+
+    def _notify(self, event: str, payload: Dict):
+        payload = {**payload, "station": self.station}
+        for listener in self.listeners:
+            try:
+                listener(event, payload)
+            except Exception as e:
+                print(f"[STORAGE] Ошибка подписчика на {event}: {e}")
+
+    async def _call_google(self, action: str, data: Dict = None, user_id: int = None,
+                           force_refresh: bool = False) -> ApiResponse:
+        # requests блокирующий - выполняем в потоке, чтобы не останавливать event loop
+        return await asyncio.to_thread(self.google.call_api, action, data, user_id, force_refresh)
+
+    def shared(self, action: str, *args) -> asyncio.Task:
+        """
+        Одно чтение на ключ (действие, аргументы): пока запрос в полёте, повторный вызов получает
+        ту же задачу, а не второй запрос к upstream. Задачу можно передать в gather.
+        """
+        key = (action, *args)
+        task = self.inflight.get(key)
+        if task is None:
+            task = self.inflight[key] = asyncio.ensure_future(getattr(self, action)(*args))
+            task.add_done_callback(lambda done: self._shared_done(key, done))
+        return task
+
+    def _shared_done(self, key: Tuple, task: asyncio.Task):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        # Исключение забираем, даже если результат никто не ждёт - иначе asyncio пишет "never retrieved"
+        if not task.cancelled():
+            task.exception()
+
+    def prefetch(self, action: str, *args) -> Optional[asyncio.Task]:
+        """Прогрев кэша чтением в фоне (через shared); в LOCAL кэша нет и чтение дешёвое - не нужен"""
+        if self.mode == "LOCAL":
+            return None
+        return self.shared(action, *args)
+
+    async def gather(self, *calls, timeout: Optional[float] = Config.STORAGE_DEADLINE) -> List[ApiResponse]:
+        """
+        Выполняет независимые запросы параллельно с общим дедлайном.
+        Для упавших и не успевших к дедлайну запросов возвращается ApiResponse.error.
+        Переданные готовые задачи (shared) по дедлайну не отменяются - их могут ждать другие.
+        """
+        tasks = [asyncio.ensure_future(call) for call in calls]
+        if not tasks:
+            return []
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for call, task in zip(calls, tasks):
+            if task in pending and not asyncio.isfuture(call):
+                task.cancel()
+
+        results = []
+        for task in tasks:
+            if task in pending:
+                results.append(ApiResponse.error("Превышено время ожидания ответа"))
+            elif task.cancelled():
+                # Общую задачу shared могли отменить до gather
+                results.append(ApiResponse.error("Запрос отменён"))
+            elif task.exception():
+                results.append(ApiResponse.error(str(task.exception())))
+            else:
+                results.append(task.result())
+        return results
 
     async def get_available_dates(self, user_id: int, **kwargs) -> ApiResponse:
         if self.mode == "LOCAL":
             return self.local.get_available_dates(user_id)
-        result = self.google.call_api("get_available_dates", {}, user_id, kwargs.get('force_refresh', False))
+        result = await self._call_google("get_available_dates", {}, user_id, kwargs.get('force_refresh', False))
         if self.mode == "HYBRID" and result.status == "error":
             return self.local.get_available_dates(user_id)
         return result
 
-    async def get_free_times(self, date: str, blood_group: str) -> ApiResponse:
+    async def get_free_times(self, date: str, blood_group: str, user_id: Optional[int] = None) -> ApiResponse:
+        """Свободное время; места, удержанные другими донорами (не user_id), вычитаются из квоты"""
+        result = await self._get_free_times(date, blood_group)
+        if result.status == "success" and isinstance(result.data, dict):
+            return ApiResponse.success(self._observe_free_times(date, blood_group, result.data, user_id))
+        return result
+
+    def _observe_free_times(self, date: str, blood_group: str, data: Dict, user_id: Optional[int]) -> Dict:
+        self._notify("free_times", {"date": date, "blood_group": blood_group, **data})
+        return self.holds.apply(date, blood_group, data, user_id)
+
+    async def _get_free_times(self, date: str, blood_group: str) -> ApiResponse:
         if self.mode == "LOCAL":
             return self.local.get_free_times(date, blood_group)
-        result = self.google.call_api("get_free_times", {"date": date, "blood_group": blood_group})
+        result = await self._call_google("get_free_times", {"date": date, "blood_group": blood_group})
         if self.mode == "HYBRID" and result.status == "error":
             return self.local.get_free_times(date, blood_group)
         return result
@@ -351,70 +1206,362 @@ class StorageAdapter:
     async def check_existing(self, date: str, user_id: int) -> ApiResponse:
         if self.mode == "LOCAL":
             return await self.local.check_existing(date, user_id)
-        result = self.google.call_api("check_existing", {"date": date}, user_id)
+        result = await self._call_google("check_existing", {"date": date}, user_id)
         if self.mode == "HYBRID" and result.status == "error":
             return await self.local.check_existing(date, user_id)
         return result
 
-    async def register(self, date: str, blood_group: str, time_slot: str, user_id: int) -> ApiResponse:
+    async def register(self, date: str, blood_group: str, time_slot: str, user_id: int,
+                       expected_version: Optional[int] = None) -> ApiResponse:
+        """
+        Оптимистичная запись: backend принимает её, только если версия слота совпадает с expected_version -
+        той, что донор видел, когда ему показали время (FSM slot_version). При конфликте ответ содержит свежее
+        состояние - если время и место ещё свободны, повторяем с новой версией, без блокировок и повторных
+        чтений. Старый скрипт версий не присылает - тогда запись идёт без проверки, как раньше.
+        В успешном ответе уже есть quota_remaining.
+        """
+        reserved = self.holds.held_by_others(date, blood_group, user_id)
+        if reserved and reserved >= self.holds.last_quota.get((date, blood_group), reserved + 1):
+            # Все оставшиеся места удержаны другими - отказываем без запроса к backend
+            return ApiResponse.error("Все квоты заняты")
+        for _ in range(Config.REGISTER_CONFLICT_RETRIES + 1):
+            result = await self._register(date, blood_group, time_slot, user_id, reserved, expected_version)
+            if result.status != "conflict":
+                break
+            fresh = self._observe_free_times(date, blood_group, result.data, user_id)
+            expected_version = fresh.get("version")
+            if not fresh.get("quota"):
+                return ApiResponse.error("Все квоты заняты")
+            if time_slot not in fresh.get("times", []):
+                return ApiResponse.error("Время уже занято")
+            reserved = self.holds.held_by_others(date, blood_group, user_id)
+        else:
+            return ApiResponse.error("Слишком много одновременных записей, попробуйте ещё раз")
+
+        if result.status == "success":
+            if "quota_remaining" not in result.data:
+                # Скрипт без версий не сообщает остаток
+                free = await self.get_free_times(date, blood_group, user_id)
+                if free.status == "success":
+                    result.data["quota_remaining"] = free.data.get("quota", 0)
+            # Удержание этого же места ушло в запись; удержание другого места действительно освобождается
+            self.holds.release(user_id, notify=self.holds.by_user.get(user_id) != (date, blood_group))
+            self._notify("booked", {"date": date, "time": time_slot, "blood_group": blood_group,
+                                    **result.data, "user_id": user_id})
+        return result
+
+    async def _register(self, date: str, blood_group: str, time_slot: str, user_id: int,
+                        reserved: int = 0, expected_version: Optional[int] = None) -> ApiResponse:
         if self.mode == "LOCAL":
-            return await self.local.register(date, blood_group, time_slot, user_id)
-        result = self.google.call_api("register", {"date": date, "blood_group": blood_group, "time": time_slot}, user_id)
+            return await self.local.register(date, blood_group, time_slot, user_id, reserved, expected_version)
+        payload = {"date": date, "blood_group": blood_group, "time": time_slot}
+        if expected_version is not None:
+            payload["expected_version"] = expected_version
+        result = await self._call_google("register", payload, user_id)
         if self.mode == "HYBRID" and result.status == "error":
-            return await self.local.register(date, blood_group, time_slot, user_id)
+            # Версии локального хранилища не связаны с версиями скрипта - пишем без проверки
+            return await self.local.register(date, blood_group, time_slot, user_id, reserved)
+        return result
+
+    async def cancel_booking(self, date: Optional[str], ticket: str, user_id: int) -> ApiResponse:
+        result = await self._cancel_booking(date, ticket, user_id)
+        if result.status == "success":
+            details = result.data if isinstance(result.data, dict) else {}
+            self._notify("cancelled", {"date": date, **details, "ticket": ticket, "user_id": user_id})
         return result
 
-    async def cancel_booking(self, date: str, ticket: str, user_id: int) -> ApiResponse:
+    async def _cancel_booking(self, date: Optional[str], ticket: str, user_id: int) -> ApiResponse:
         if self.mode == "LOCAL":
             return await self.local.cancel_booking(date, ticket, user_id)
-        result = self.google.call_api("cancel_booking", {"date": date, "ticket": ticket}, user_id)
+        payload = {"ticket": ticket} if date is None else {"date": date, "ticket": ticket}
+        result = await self._call_google("cancel_booking", payload, user_id)
         if self.mode == "HYBRID" and result.status == "error":
             return await self.local.cancel_booking(date, ticket, user_id)
         return result
 
-    async def get_user_bookings(self, user_id: int) -> ApiResponse:
+    async def get_user_bookings(self, user_id: int, archived: bool = False, cursor: Optional[str] = None,
+                                limit: int = Config.BOOKINGS_PAGE_SIZE) -> ApiResponse:
         if self.mode == "LOCAL":
-            return self.local.get_user_bookings(user_id)
-        result = self.google.call_api("get_user_bookings", {}, user_id)
+            return self.local.get_user_bookings(user_id, archived, cursor, limit)
+        payload = {"archived": archived, "limit": limit}
+        if cursor:
+            payload["cursor"] = cursor
+        result = await self._call_google("get_user_bookings", payload, user_id)
         if self.mode == "HYBRID" and result.status == "error":
-            return self.local.get_user_bookings(user_id)
+            return self.local.get_user_bookings(user_id, archived, cursor, limit)
+        if result.status == "success" and "next_cursor" not in result.data:
+            # Старая версия скрипта игнорирует параметры и отдаёт все записи - делим на страницы здесь
+            return ApiResponse.success(paginate_bookings(result.data.get("bookings", []), archived, cursor, limit))
         return result
 
-    async def get_stats(self) -> ApiResponse:
+    async def get_stats(self, with_users: bool = False) -> ApiResponse:
+        """with_users - добавить user_ids, чтобы StationRegistry посчитал пользователей без повторов"""
         if self.mode == "LOCAL":
-            return self.local.get_stats()
-        result = self.google.call_api("get_stats", {})
+            return await reports.local_stats(self.local, with_users=with_users)
+        result = await self._call_google("get_stats", {"with_users": True} if with_users else {})
         if self.mode == "HYBRID" and result.status == "error":
-            return self.local.get_stats()
+            return await reports.local_stats(self.local, with_users=with_users)
         return result
 
     def clear_cache(self):
         if self.mode in ["GOOGLE", "HYBRID"]:
             self.google.clear_cache()
 
-# Инициализация
-google_client = GoogleScriptClient(Config.GOOGLE_SCRIPT_URL)
-local_storage = LocalStorage()
-storage = StorageAdapter(Config.MODE, google_client, local_storage)
+# Инициализация: компоненты создаются при первом обращении
+class Lazy:
+    """Прокси, создающий объект фабрикой при первом обращении к атрибуту"""
+    def __init__(self, factory):
+        self._factory = factory
+        self._instance = None
+
+    def get(self):
+        if self._instance is None:
+            self._instance = self._factory()
+        return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+# ========== СТАНЦИИ ==========
+def load_stations(path: str = Config.STATIONS_FILE) -> Dict[str, Dict]:
+    """
+    Станции из JSON вида {"id": {"code": 0, "name": ..., "url": ..., "quotas": {...}, "working_hours": [...]}}.
+    code (0-255) - постоянный номер станции, он хранится в кнопках; менять его у существующей станции нельзя.
+    Без code номером считается позиция в файле, как в конфигах до его появления.
+    Без файла - одна станция Config.DEFAULT_STATION с Config.GOOGLE_SCRIPT_URL.
+    """
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    return {Config.DEFAULT_STATION: {"name": "Донорская станция", "url": Config.GOOGLE_SCRIPT_URL}}
+
+class StationRegistry:
+    """
+    Маршрутизация хранилища по станциям. У каждой станции свой StorageAdapter: отдельный Google Script
+    со своим requests.Session (пулом соединений), кэшем и circuit breaker, свой LocalStorage с квотами
+    и часами работы, свои удержания мест. Адаптеры создаются при первом обращении к станции.
+    Индекс user_stations помнит, на каких станциях есть записи донора: проверка даты и "Мои записи"
+    обращаются только к ним, а не ко всем станциям. Индекс донора строится одним опросом всех станций
+    при первом обращении и дальше поддерживается событиями адаптеров.
+    """
+    def __init__(self, config: Optional[Dict[str, Dict]] = None):
+        self.config = config if config is not None else load_stations()
+        self.ids = list(self.config)
+        self.default = Config.DEFAULT_STATION if Config.DEFAULT_STATION in self.config else self.ids[0]
+        self.codes = {station: conf.get("code", i) for i, (station, conf) in enumerate(self.config.items())}
+        self.stations_by_code = {code: station for station, code in self.codes.items()}
+        if len(self.stations_by_code) != len(self.codes) or not all(0 <= c <= 255 for c in self.codes.values()):
+            raise ValueError(f"Коды станций должны быть разными и в диапазоне 0-255: {self.codes}")
+        self.adapters: Dict[str, StorageAdapter] = {}
+        # Станции, где у донора есть или были записи; отмена станцию не убирает - лишний запрос безопаснее
+        self.user_stations: Dict[int, Set[str]] = {}
+        self.listeners: List[Callable[[str, Dict], None]] = []
+        # Общий выпуск талонов: локальные шарды не выдадут одинаковых номеров
+        self.ticket_issuer = TicketIssuer()
+
+    @property
+    def multiple(self) -> bool:
+        return len(self.ids) > 1
+
+    def backend(self, station: Optional[str] = None) -> StorageAdapter:
+        station = station if station in self.config else self.default
+        adapter = self.adapters.get(station)
+        if adapter is None:
+            adapter = self.adapters[station] = self._create(station)
+        return adapter
+
+    def _create(self, station: str) -> StorageAdapter:
+        conf = self.config[station]
+        google = Lazy(lambda: GoogleScriptClient(conf.get("url") or Config.GOOGLE_SCRIPT_URL))
+        # В режиме GOOGLE локальное хранилище создаётся, только если к нему действительно обратятся
+        local = Lazy(lambda: LocalStorage(
+            seed_test_data=Config.SEED_TEST_DATA and station == self.default,
+            quotas=conf.get("quotas"), working_hours=conf.get("working_hours"), ticket_issuer=self.ticket_issuer,
+        ))
+        adapter = StorageAdapter(Config.MODE, google, local, station)
+        adapter.subscribe(self._on_storage_event)
+        for listener in self.listeners:
+            adapter.subscribe(listener)
+        return adapter
+
+    def all(self) -> List[StorageAdapter]:
+        return [self.backend(station) for station in self.ids]
+
+    def subscribe(self, listener: Callable[[str, Dict], None]):
+        self.listeners.append(listener)
+        for adapter in self.adapters.values():
+            adapter.subscribe(listener)
+
+    def code(self, station: Optional[str]) -> int:
+        return self.codes.get(station, self.codes[self.default])
+
+    def by_code(self, code: int) -> str:
+        return self.stations_by_code.get(code, self.default)
+
+    def name(self, station: Optional[str]) -> str:
+        return self.config.get(station or self.default, {}).get("name", station or self.default)
+
+    def clear_cache(self):
+        for adapter in self.adapters.values():
+            adapter.clear_cache()
+        # Записи, сделанные мимо бота (например, в таблице станции), подхватятся при следующем обращении
+        self.user_stations.clear()
+
+    def _on_storage_event(self, event: str, payload: Dict):
+        if event == "booked" and payload["user_id"] in self.user_stations:
+            self.user_stations[payload["user_id"]].add(payload["station"])
+
+    async def stations_of(self, user_id: int) -> List[StorageAdapter]:
+        """
+        Адаптеры станций с записями донора, в порядке stations.json. Незнакомого донора ищем на всех
+        станциях (страница из одной записи - нужны только счётчики). Станция, которая не ответила,
+        считается возможной, а донор остаётся непроиндексированным до следующего обращения.
+        """
+        known = self.user_stations.get(user_id)
+        if known is None:
+            adapters = self.all()
+            responses = await adapters[0].gather(
+                *(a.get_user_bookings(user_id, False, None, 1) for a in adapters))
+            known = {a.station for a, r in zip(adapters, responses)
+                     if r.status != "success" or r.data.get("upcoming_count") or r.data.get("archived_count")}
+            if all(r.status == "success" for r in responses):
+                self.user_stations[user_id] = known
+        return [self.backend(station) for station in self.ids if station in known]
+
+    async def check_existing(self, date: str, user_id: int, station: Optional[str] = None) -> ApiResponse:
+        """
+        Одна запись на дату - на всех станциях сразу; в ответе с exists указана станция записи.
+        Ошибка других станций не мешает записи на station: она выводится в лог и пропускается.
+        """
+        adapters = await self.stations_of(user_id)
+        if not adapters:
+            return ApiResponse.success({"exists": False})
+        responses = await adapters[0].gather(*(a.check_existing(date, user_id) for a in adapters))
+        for adapter, resp in zip(adapters, responses):
+            if resp.status == "success" and resp.data.get("exists"):
+                return ApiResponse.success({**resp.data, "station": adapter.station})
+        for adapter, resp in zip(adapters, responses):
+            if resp.status != "success":
+                if adapter.station == self.backend(station).station:
+                    return resp
+                print(f"[STATIONS] {adapter.station}: проверка записи на {date} не удалась ({resp.data})")
+        return ApiResponse.success({"exists": False})
+
+    async def get_user_bookings(self, user_id: int, archived: bool = False, cursor: Optional[str] = None,
+                                limit: int = Config.BOOKINGS_PAGE_SIZE) -> ApiResponse:
+        """
+        Страница записей по станциям донора: страницы станций сливаются по (дата, код станции).
+        Курсор "дата@код": станции читаются с этой даты включительно, записи той же даты на станциях
+        с меньшим кодом уже были на прошлой странице. У станции на дату не больше одной записи,
+        поэтому limit + 1 записей с каждой станции хватает, чтобы отброшенные не оставили пробелов.
+        """
+        adapters = await self.stations_of(user_id)
+        if not adapters:
+            return ApiResponse.success({"bookings": [], "count": 0, "next_cursor": None,
+                                        "upcoming_count": 0, "archived_count": 0})
+        cursor_date, _, cursor_station = (cursor or "").partition("@")
+        responses = await adapters[0].gather(
+            *(a.get_user_bookings(user_id, archived, cursor_date or None, limit + 1) for a in adapters))
+        pages = [(a.station, r.data) for a, r in zip(adapters, responses) if r.status == "success"]
+        if not pages:
+            return responses[0]
+        order = self.codes
+        skip = int(cursor_station or 0)
+        merged = [{**b, "station": station} for station, page in pages for b in page.get("bookings", [])
+                  if not (b["date"] == cursor_date and order[station] < skip)]
+        merged.sort(key=lambda b: order[b["station"]])
+        merged.sort(key=lambda b: b["date"], reverse=archived)
+        cursors = [page["next_cursor"] for _, page in pages if page.get("next_cursor")]
+        if len(merged) > limit:
+            following = merged[limit]
+            next_cursor = f"{following['date']}@{order[following['station']]}"
+        elif cursors:
+            next_cursor = max(cursors) if archived else min(cursors)
+        else:
+            next_cursor = None
+        return ApiResponse.success({
+            "bookings": merged[:limit], "count": len(merged[:limit]), "next_cursor": next_cursor,
+            "upcoming_count": sum(page.get("upcoming_count", 0) for _, page in pages),
+            "archived_count": sum(page.get("archived_count", 0) for _, page in pages),
+        })
+
+    async def get_stats(self) -> ApiResponse:
+        adapters = self.all()
+        if Config.MODE == "LOCAL":
+            # Один проход по общему срезу всех шардов: донор с записями на нескольких станциях - один пользователь
+            return await reports.local_stats(*(a.local for a in adapters))
+        if len(adapters) == 1:
+            return await adapters[0].get_stats()
+        responses = await adapters[0].gather(*(a.get_stats(with_users=True) for a in adapters))
+        stats = [r.data for r in responses if r.status == "success"]
+        if not stats:
+            return responses[0]
+        day_stats, blood_stats = defaultdict(int), defaultdict(int)
+        users, unlisted = set(), 0
+        for d in stats:
+            for day, n in d.get("day_stats", {}).items():
+                day_stats[day] += n
+            for group, n in d.get("blood_group_stats", {}).items():
+                blood_stats[group] += n
+            if "user_ids" in d:
+                users.update(d["user_ids"])
+            else:
+                # Скрипт без with_users присылает только число - повторы между станциями не исключить
+                unlisted += d.get("total_users", 0)
+        return ApiResponse.success({
+            "total_bookings": sum(d.get("total_bookings", 0) for d in stats),
+            "total_users": len(users) + unlisted,
+            "day_stats": dict(day_stats), "blood_group_stats": dict(blood_stats),
+            "most_popular_day": max(day_stats, key=day_stats.get) if day_stats else "нет данных",
+            "most_popular_blood_group": max(blood_stats, key=blood_stats.get) if blood_stats else "нет данных",
+        })
+
+stations = Lazy(StationRegistry)
 
 # ========== СЕРВИСЫ ==========
 class SessionTimeout:
     def __init__(self, timeout: int = Config.SESSION_TIMEOUT):
         self.timeout = timeout
         self.activities: Dict[int, float] = {}
-
-    def update(self, user_id: int):
-        self.activities[user_id] = time.time()
+        # Последние действия в порядке времени - для подсчёта активных сессий без обхода всех
+        self.recent: Dict[int, float] = {}
+
+    def update(self, user_id: int, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        self.activities[user_id] = now
+        self.recent.pop(user_id, None)
+        self.recent[user_id] = now
+
+    def active_count(self) -> int:
+        """Число сессий моложе timeout; устаревшие снимаются с головы очереди"""
+        deadline = time.time() - self.timeout
+        while self.recent:
+            user_id, ts = next(iter(self.recent.items()))
+            if ts > deadline:
+                break
+            del self.recent[user_id]
+        return len(self.recent)
 
     def is_expired(self, user_id: int) -> bool:
         if user_id not in self.activities:
             return False
         return time.time() - self.activities[user_id] > self.timeout
 
+    def touch(self, user_id: int) -> bool:
+        """Проверка и продление за один вызов: True - сессия истекла и снята, иначе активность обновлена"""
+        now = time.time()
+        last = self.activities.get(user_id)
+        if last is not None and now - last > self.timeout:
+            self.clear(user_id)
+            return True
+        self.update(user_id, now)
+        return False
+
     def clear(self, user_id: int):
         self.activities.pop(user_id, None)
+        self.recent.pop(user_id, None)
 
-session_timeout = SessionTimeout()
+session_timeout = Lazy(SessionTimeout)
 
 class RateLimiter:
     def __init__(self, max_req: int = Config.RATE_LIMIT_REQUESTS, window: int = Config.RATE_LIMIT_WINDOW):
@@ -430,10 +1577,834 @@ class RateLimiter:
         self.requests[user_id].append(now)
         return True
 
-rate_limiter = RateLimiter()
+rate_limiter = Lazy(RateLimiter)
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Забирает токен и возвращает, сколько секунд нужно подождать (0 - можно сразу)"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def is_idle(self) -> bool:
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+class SendScheduler:
+    """
+    Исходящие запросы к Telegram: параллельно между чатами и строго по порядку внутри чата.
+    Учитывает глобальный и per-chat лимиты, на 429 ждёт retry_after и повторяет запрос.
+    """
+    def __init__(self, global_rate: float = Config.SEND_GLOBAL_RATE, chat_rate: float = Config.SEND_CHAT_RATE,
+                 max_retries: int = Config.SEND_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.max_retries = max_retries
+        self.queues: Dict[int, deque] = {}
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.workers: Dict[int, asyncio.Task] = {}
+
+    def send(self, chat_id: int, request) -> asyncio.Future:
+        """Ставит в очередь чата request - функцию без аргументов, возвращающую корутину"""
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.queues.setdefault(chat_id, deque()).append((request, future))
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self._drain(chat_id))
+        return future
+
+    def edit_text(self, message: types.Message, text: str, **kwargs) -> asyncio.Future:
+        return self.send(message.chat.id, lambda: message.edit_text(text, **kwargs))
+
+    def answer(self, message: types.Message, text: str, **kwargs) -> asyncio.Future:
+        return self.send(message.chat.id, lambda: message.answer(text, **kwargs))
+
+    async def ack(self, callback: CallbackQuery, text: Optional[str] = None, show_alert: bool = False):
+        """Ответ на callback отправляется вне очереди, чтобы сразу убрать "часики" у кнопки"""
+        try:
+            await callback.answer(text, show_alert=show_alert)
+        except Exception as e:
+            print(f"[SEND] Не удалось ответить на callback: {e}")
+
+    async def _drain(self, chat_id: int):
+        queue = self.queues[chat_id]
+        bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate, self.chat_rate))
+        try:
+            while queue:
+                request, future = queue.popleft()
+                try:
+                    future.set_result(await self._send(chat_id, request, bucket))
+                except Exception as e:
+                    print(f"[SEND] Ошибка отправки в чат {chat_id}: {e}")
+                    future.set_exception(e)
+        finally:
+            del self.workers[chat_id]
+            del self.queues[chat_id]
+            if bucket.is_idle():
+                self.chat_buckets.pop(chat_id, None)
+
+    async def _send(self, chat_id: int, request, bucket: TokenBucket):
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await request()
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                print(f"[SEND] Flood control в чате {chat_id}, повтор через {e.retry_after} с")
+                await asyncio.sleep(e.retry_after)
+
+outbox = Lazy(SendScheduler)
+
+# ========== НАПОМИНАНИЯ ==========
+class ReminderScheduler:
+    """
+    Напоминания донорам перед визитом (Config.REMINDER_OFFSETS до начала).
+    Очередь - куча (fire_at, ticket, offset): ближайшее напоминание берётся за O(log n), без
+    периодического обхода всех записей. Отменённые записи удаляются из кучи лениво - при извлечении
+    сверяются с self.active. Состояние сохраняется в JSON и восстанавливается после перезапуска.
+    """
+    def __init__(self, path: str = Config.REMINDERS_FILE, offsets=Config.REMINDER_OFFSETS,
+                 batch_size: int = Config.REMINDER_BATCH_SIZE):
+        self.path = path
+        self.offsets = offsets
+        self.batch_size = batch_size
+        self.heap: List[Tuple[float, str, int]] = []
+        self.active: Dict[str, Dict] = {}
+        self._wakeup = asyncio.Event()
+        self._save_handle = None
+
+    def on_storage_event(self, event: str, payload: Dict):
+        if event == "booked":
+            self.schedule(payload)
+        elif event == "cancelled":
+            self.cancel(payload["ticket"])
+
+    def schedule(self, booking: Dict):
+        try:
+            start = datetime.strptime(f"{booking['date']} {booking['time']}", "%Y-%m-%d %H:%M").timestamp()
+        except (KeyError, ValueError):
+            return
+        now = time.time()
+        pending = 0
+        for offset in self.offsets:
+            if start - offset > now:
+                heapq.heappush(self.heap, (start - offset, booking["ticket"], offset))
+                pending += 1
+        if not pending:
+            return
+        self.active[booking["ticket"]] = {
+            "user_id": booking["user_id"], "date": booking["date"], "time": booking["time"],
+            "blood_group": booking.get("blood_group", ""), "station": booking.get("station"), "pending": pending,
+        }
+        self._wakeup.set()
+        self._mark_dirty()
+
+    def cancel(self, ticket: str):
+        if self.active.pop(ticket, None):
+            self._mark_dirty()
+            # Не даём куче бесконечно расти из-за лениво удалённых элементов
+            if len(self.heap) > 2 * len(self.active) * len(self.offsets) + 64:
+                self.heap = [item for item in self.heap if item[1] in self.active]
+                heapq.heapify(self.heap)
+
+    def _outdated(self, fire_at: float, offset: int, now: float) -> bool:
+        """
+        После простоя или перезапуска: визит уже начался или наступил срок более близкого напоминания -
+        тогда это напоминание не отправляется ("завтра" за час до визита никому не нужно)
+        """
+        start = fire_at + offset
+        return start <= now or any(o < offset and start - o <= now for o in self.offsets)
+
+    def _pop_due(self, now: float) -> List[Tuple[str, int, Dict]]:
+        due = []
+        while self.heap and self.heap[0][0] <= now and len(due) < self.batch_size:
+            fire_at, ticket, offset = heapq.heappop(self.heap)
+            info = self.active.get(ticket)
+            if info is None:
+                continue
+            info["pending"] -= 1
+            if info["pending"] <= 0:
+                del self.active[ticket]
+            if not self._outdated(fire_at, offset, now):
+                due.append((ticket, offset, info))
+        return due
+
+    async def run(self, bot: Bot):
+        while True:
+            self._wakeup.clear()
+            due = self._pop_due(time.time())
+            if due:
+                self._mark_dirty()
+                # Пачка уходит через outbox (лимиты Telegram), следующая - после её отправки
+                await asyncio.gather(*(self._send(bot, *item) for item in due), return_exceptions=True)
+                continue
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _send(self, bot: Bot, ticket: str, offset: int, info: Dict) -> asyncio.Future:
+        try:
+            display = datetime.strptime(info["date"], "%Y-%m-%d").strftime("%d.%m.%Y")
+        except ValueError:
+            display = info["date"]
+        if offset >= 24 * 3600:
+            when = "завтра"
+        elif offset >= 3600:
+            when = f"через {offset // 3600} ч"
+        else:
+            when = f"через {offset // 60} мин"
+        text = (f"⏰ *Напоминание*: {when} вы записаны на донорство\n"
+                f"• Дата: *{display}*\n"
+                f"• Время: *{info['time']}*\n"
+                f"• Группа: *{info['blood_group']}*\n"
+                f"• Талон: *{ticket}*")
+        builder = InlineKeyboardBuilder()
+        builder.row(InlineKeyboardButton(
+            text="❌ Не смогу прийти",
+            callback_data=CallbackCodec.encode(CallbackAction.CANCEL_ASK, info["date"], ticket,
+                                               stations.code(info.get("station")))
+        ))
+        return outbox.send(info["user_id"], lambda: bot.send_message(
+            chat_id=info["user_id"], text=text, parse_mode="Markdown", reply_markup=builder.as_markup()
+        ))
+
+    def _mark_dirty(self):
+        if self._save_handle is None:
+            self._save_handle = asyncio.get_running_loop().call_later(Config.REMINDER_SAVE_DELAY, self.save)
+
+    def save(self):
+        self._save_handle = None
+        data = {
+            "reminders": [item for item in self.heap if item[1] in self.active],
+            "active": self.active,
+        }
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"[REMINDERS] Не удалось сохранить очередь: {e}")
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"[REMINDERS] Не удалось прочитать очередь: {e}")
+            return
+        now = time.time()
+        active = data.get("active", {})
+        self.heap = [tuple(item) for item in data.get("reminders", [])
+                     if item[1] in active and not self._outdated(item[0], item[2], now)]
+        heapq.heapify(self.heap)
+        pending = Counter(ticket for _, ticket, _ in self.heap)
+        self.active = {ticket: {**info, "pending": pending[ticket]} for ticket, info in active.items() if pending[ticket]}
+        dropped = len(data.get("reminders", [])) - len(self.heap)
+        print(f"[REMINDERS] Восстановлено напоминаний: {len(self.heap)}, устаревших пропущено: {dropped}")
+
+reminders = Lazy(ReminderScheduler)
+
+# ========== ЛИСТ ОЖИДАНИЯ ==========
+class Waitlist:
+    """
+    Лист ожидания по (станция, дата, группа крови). Очередь - dict в порядке вставки: FIFO с O(1)
+    добавлением, извлечением первого и удалением из середины.
+    Когда запись отменяют или удержанное место освобождается без записи (донор ушёл, удержание истекло),
+    первый в очереди получает предложение на WAITLIST_OFFER_TTL секунд; при отказе или молчании
+    его удержание снимается и место сразу предлагается следующему.
+    """
+    def __init__(self, offer_ttl: float = Config.WAITLIST_OFFER_TTL):
+        self.offer_ttl = offer_ttl
+        self.queues: Dict[Tuple[str, str, str], Dict[int, None]] = {}
+        self.offers: Dict[Tuple[int, str, str, str], asyncio.TimerHandle] = {}
+        self.bot: Optional[Bot] = None
+
+    def join(self, station: str, date: str, blood_group: str, user_id: int) -> int:
+        """Добавляет донора в конец очереди и возвращает его позицию"""
+        queue = self.queues.setdefault((station, date, blood_group), {})
+        if user_id in queue:
+            return list(queue).index(user_id) + 1
+        queue[user_id] = None
+        return len(queue)
+
+    def leave(self, station: str, date: str, blood_group: str, user_id: int):
+        key = (station, date, blood_group)
+        queue = self.queues.get(key)
+        if queue and user_id in queue:
+            del queue[user_id]
+            if not queue:
+                del self.queues[key]
+
+    def on_storage_event(self, event: str, payload: Dict):
+        station, date, blood_group = payload.get("station"), payload.get("date"), payload.get("blood_group")
+        if event == "booked":
+            self.leave(station, date, blood_group, payload["user_id"])
+            self._close_offer(payload["user_id"], (station, date, blood_group))
+        elif event == "released":
+            self.offer_next((station, date, blood_group))
+        elif event == "cancelled" and date:
+            if blood_group:
+                self.offer_next((station, date, blood_group))
+            else:
+                # Upstream не сообщил группу - предлагаем всем очередям даты, время перепроверится при согласии
+                for key in [k for k in self.queues if k[:2] == (station, date)]:
+                    self.offer_next(key)
+
+    def offer_next(self, key: Tuple[str, str, str]) -> bool:
+        queue = self.queues.get(key)
+        while queue:
+            user_id = next(iter(queue))
+            del queue[user_id]
+            if not queue:
+                del self.queues[key]
+            if (user_id, *key) in self.offers:
+                continue
+            self.offers[(user_id, *key)] = asyncio.get_running_loop().call_later(
+                self.offer_ttl, self._expire, user_id, key
+            )
+            # Освободившееся место не достанется тому, кто просто открыл список времени
+            station, date, blood_group = key
+            stations.backend(station).holds.hold(date, blood_group, user_id, ttl=self.offer_ttl)
+            self._send_offer(user_id, key)
+            return True
+        return False
+
+    def accept(self, user_id: int, station: str, date: str, blood_group: str) -> bool:
+        """True, если предложение ещё действует; после этого донор оформляет запись обычным путём"""
+        return self._close_offer(user_id, (station, date, blood_group))
+
+    def decline(self, user_id: int, station: str, date: str, blood_group: str):
+        if self._close_offer(user_id, (station, date, blood_group)):
+            # Снятие удержания сообщит "released" - место уйдёт следующему в очереди
+            stations.backend(station).holds.release(user_id, (date, blood_group))
+
+    def _close_offer(self, user_id: int, key: Tuple[str, str, str]) -> bool:
+        handle = self.offers.pop((user_id, *key), None)
+        if handle is None:
+            return False
+        handle.cancel()
+        return True
+
+    def _expire(self, user_id: int, key: Tuple[str, str, str]):
+        if self.offers.pop((user_id, *key), None) is None:
+            return
+        station, date, blood_group = key
+        if self.bot:
+            outbox.send(user_id, lambda: self.bot.send_message(
+                chat_id=user_id, text="⌛ Время на подтверждение истекло, место предложено следующему донору"
+            ))
+        # Снятие удержания сообщит "released"; если оно уже снято (истекло, донор ушёл к другому месту),
+        # событие уже было и место предложено
+        stations.backend(station).holds.release(user_id, (date, blood_group))
+
+    def _send_offer(self, user_id: int, key: Tuple[str, str, str]):
+        if not self.bot:
+            return
+        station, date, blood_group = key
+        try:
+            display = datetime.strptime(date, "%Y-%m-%d").strftime("%d.%m.%Y")
+        except ValueError:
+            display = date
+        code = stations.code(station)
+        builder = InlineKeyboardBuilder()
+        builder.row(
+            InlineKeyboardButton(text="✅ Записаться", callback_data=CallbackCodec.encode(
+                CallbackAction.WAITLIST_ACCEPT, date, blood_group, code)),
+            InlineKeyboardButton(text="❌ Отказаться", callback_data=CallbackCodec.encode(
+                CallbackAction.WAITLIST_DECLINE, date, blood_group, code))
+        )
+        place = f"🏥 {stations.name(station)}\n" if stations.multiple else ""
+        text = (f"🔔 *Освободилось место!*\n{place}📅 {display}\n🩸 {blood_group}\n\n"
+                f"Подтвердите в течение {int(self.offer_ttl // 60)} мин, иначе место уйдёт следующему.")
+        outbox.send(user_id, lambda: self.bot.send_message(
+            chat_id=user_id, text=text, parse_mode="Markdown", reply_markup=builder.as_markup()
+        ))
+
+waitlist = Lazy(Waitlist)
+
+# ========== ПАНЕЛЬ АДМИНИСТРАТОРА ==========
+class DashboardMetrics:
+    """
+    Заполненность квот по (станция, дата, группа крови). Счётчики обновляются по событиям хранилища:
+    booked/cancelled сдвигают занятость на 1, ответы free_times задают точные значения.
+    Отрисовка проходит только по агрегатам, а не по записям, и годится для обновления раз в несколько секунд.
+    """
+    SHADES = "░▒▓█"
+
+    def __init__(self, seed_local: bool = False):
+        self.used: Dict[Tuple[str, str, str], int] = {}
+        self.total: Dict[Tuple[str, str, str], int] = {}
+        # В режиме LOCAL начальные значения один раз считаются по хранилищам станций при первом показе
+        self.seed_local = seed_local
+
+    def on_storage_event(self, event: str, payload: Dict):
+        key = (payload.get("station"), payload.get("date"), payload.get("blood_group"))
+        if not all(key):
+            return
+        if event == "free_times":
+            self.observe(key, payload)
+        elif event == "booked":
+            self.used[key] = self.used.get(key, 0) + 1
+        elif event == "cancelled" and self.used.get(key):
+            self.used[key] -= 1
+
+    def observe(self, key: Tuple[str, str, str], data: Dict):
+        quota = data.get("quota", 0)
+        if "quota_total" in data:
+            self.total[key] = data["quota_total"]
+            self.used[key] = data.get("quota_used", data["quota_total"] - quota)
+        else:
+            # Upstream сообщает только остаток - общий объём восстанавливаем по известной занятости
+            self.total[key] = self.used.get(key, 0) + quota
+
+    def _seed(self):
+        self.seed_local = False
+        self.used = {}
+        today = date_cls.today()
+        for adapter in stations.all():
+            local, station = adapter.local, adapter.station
+            for i in range(1, Config.DASHBOARD_DAYS + 1):
+                day = today + timedelta(days=i)
+                for blood_group, total in local.quotas.get(WEEKDAYS_RU[day.weekday()], {}).items():
+                    self.total[(station, day.isoformat(), blood_group)] = total
+            for user_bookings in local.bookings.values():
+                for b in user_bookings.values():
+                    key = (station, b.date, b.blood_group)
+                    self.used[key] = self.used.get(key, 0) + 1
+
+    def _shade(self, key: Tuple[str, str, str]) -> str:
+        total = self.total.get(key)
+        if not total:
+            return "·"
+        used = min(self.used.get(key, 0), total)
+        return self.SHADES[min(len(self.SHADES) - 1, used * len(self.SHADES) // total)]
+
+    def heatmap(self, station: str) -> str:
+        today = date_cls.today().isoformat()
+        dates = sorted({d for st, d, _ in self.total if st == station and d >= today})[:Config.DASHBOARD_DAYS]
+        if not dates:
+            return "нет данных - квоты появятся после первых запросов свободного времени"
+        lines = ["      " + "".join(f"{g:<4}" for g in BLOOD_GROUPS) + "  занято"]
+        for d in dates:
+            keys = [(station, d, g) for g in BLOOD_GROUPS]
+            used = sum(min(self.used.get(k, 0), self.total.get(k, 0)) for k in keys)
+            total = sum(self.total.get(k, 0) for k in keys)
+            cells = "".join(f"{self._shade(k):<4}" for k in keys)
+            lines.append(f"{d[8:10]}.{d[5:7]} {cells}  {used}/{total}")
+        return "\n".join(lines)
+
+    def render(self) -> str:
+        if self.seed_local:
+            self._seed()
+        lines = ["📊 *Панель администратора*", ""]
+        for station in stations.ids:
+            if stations.multiple:
+                lines.append(f"🏥 *{stations.name(station)}*")
+            lines += ["```", self.heatmap(station), "```"]
+        lines += ["· нет данных  ░ <25%  ▒ <50%  ▓ <75%  █ ≥75%", ""]
+        lines.append(f"👥 Активных сессий: {session_timeout.active_count()}")
+        lines.append(f"⏳ Удержано мест: {sum(len(a.holds.by_user) for a in stations.adapters.values())}")
+        lines.append(f"🔔 В листах ожидания: {sum(len(q) for q in waitlist.queues.values())}")
+        if middleware_profiler.stats:
+            lines.append("⏱ Middleware (собственное время):")
+            lines += middleware_profiler.render()
+        if Config.MODE != "LOCAL":
+            for adapter in stations.all():
+                client = adapter.google
+                lookups = client.cache_hits + client.cache_misses
+                hit_rate = f"{client.cache_hits / lookups:.0%}" if lookups else "—"
+                prefix = f"[{stations.name(adapter.station)}] " if stations.multiple else ""
+                lines.append(f"🗄 {prefix}Кэш: попаданий {hit_rate} ({client.cache_hits}/{lookups})")
+                # Имена с подчёркиваниями - в `...`, иначе Markdown примет их за курсив
+                lines.append(f"🔌 {prefix}Upstream (`{client.circuit.state}`):")
+                for action, stats in client.latency_items():
+                    lines.append(f"  • `{action}`: ~{stats.ewma_ms:.0f} мс, p99 {stats.percentile(0.99):.0f} мс, "
+                                 f"таймаут {client.timeout_for(action):.1f} с, {stats.count} запр., "
+                                 f"ошибок {stats.errors}")
+            lines.append(f"🔁 Повторов: {retry_budget.retries}, отклонено бюджетом: {retry_budget.denied}")
+        lines.append(f"\n🕒 Обновлено {datetime.now().strftime('%H:%M:%S')}")
+        return "\n".join(lines)
+
+dashboard = Lazy(lambda: DashboardMetrics(seed_local=Config.MODE == "LOCAL"))
+
+# ========== ОТЧЁТЫ ==========
+def stats_columns(bookings: List[Booking]) -> Tuple[array, array, array]:
+    """Срез записей -> столбцы чисел (даты, группы крови, пользователи): передаются в процесс за миллисекунды"""
+    return (array("l", [b.date_ordinal for b in bookings]),
+            array("b", [b.blood_index for b in bookings]),
+            array("q", [b.user_id for b in bookings]))
+
+def compute_stats(ordinals: array, blood: array, users: array, with_users: bool = False) -> Dict:
+    """Агрегаты статистики; чистая функция верхнего уровня - выполняется в пуле процессов"""
+    day_stats: Dict[str, int] = defaultdict(int)
+    for ordinal, n in Counter(ordinals).items():
+        day_stats[WEEKDAYS_RU[(ordinal + 6) % 7]] += n
+    blood_stats = {BLOOD_GROUPS[i]: n for i, n in Counter(blood).items()}
+    distinct_users = set(users)
+    stats = {
+        "total_bookings": len(ordinals),
+        "total_users": len(distinct_users),
+        "day_stats": dict(day_stats),
+        "blood_group_stats": blood_stats,
+        "most_popular_day": max(day_stats, key=day_stats.get) if day_stats else "нет данных",
+        "most_popular_blood_group": max(blood_stats, key=blood_stats.get) if blood_stats else "нет данных",
+    }
+    if with_users:
+        stats["user_ids"] = sorted(distinct_users)
+    return stats
+
+class ReportService:
+    """
+    Тяжёлые отчёты вне event loop. Срез хранилища снимается в loop (копия списка), в столбцы переводится
+    в потоке, агрегируется в отдельном процессе (REPORT_EXECUTOR=thread - в потоке).
+    Готовые отчёты кэшируются со временем расчёта: пока отчёт моложе ttl и записи не менялись, он отдаётся
+    как есть; устаревший тоже отдаётся сразу, а пересчёт запускается в фоне. Ждать приходится только
+    самого первого расчёта.
+    """
+    def __init__(self, executor: str = Config.REPORT_EXECUTOR, ttl: float = Config.REPORT_TTL):
+        self.executor = executor
+        self.ttl = ttl
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.cache: Dict[str, Tuple[float, ApiResponse]] = {}
+        self.stale: set = set()
+        self.refreshing: Dict[str, asyncio.Task] = {}
+        self.errors: Dict[str, ApiResponse] = {}
+
+    def start(self):
+        """
+        Поднимает процесс заранее: spawn импортирует модуль заново, это секунда на первом отчёте.
+        Без вызова процесс поднимается при первом локальном отчёте.
+        """
+        if self.executor == "process" and self.pool is None:
+            # spawn, а не fork: процесс бота многопоточный (to_thread), fork мог бы унести захваченные блокировки
+            self.pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+            self.pool.submit(len, ())
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    async def _run(self, func, *args):
+        if self.executor == "process":
+            self.start()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+            except BrokenProcessPool as e:
+                print(f"[REPORTS] Процесс отчётов упал ({e}), дальше считаем в потоке")
+                self.executor = "thread"
+                self.pool = None
+        return await asyncio.to_thread(func, *args)
+
+    async def local_stats(self, *storages: LocalStorage, with_users: bool = False) -> ApiResponse:
+        """Статистика по общему срезу одного или нескольких локальных хранилищ"""
+        snapshot: List[Booking] = []
+        for storage in storages:
+            snapshot.extend(storage.tickets.values())
+        columns = await asyncio.to_thread(stats_columns, snapshot)
+        return ApiResponse.success(await self._run(compute_stats, *columns, with_users))
+
+    def on_storage_event(self, event: str, payload: Dict):
+        if event in ("booked", "cancelled"):
+            self.stale.add("stats")
+
+    async def get(self, name: str, build: Callable) -> Tuple[ApiResponse, Optional[float]]:
+        """(отчёт, unix-время расчёта); ошибки не кэшируются и возвращаются со временем None"""
+        cached = self.cache.get(name)
+        if cached is None:
+            await self._refresh(name, build)
+            cached = self.cache.get(name)
+            if cached is None:
+                return self.errors.pop(name, ApiResponse.error("Отчёт недоступен")), None
+        elif name in self.stale or time.time() - cached[0] > self.ttl:
+            self._refresh(name, build)
+        return cached[1], cached[0]
+
+    def _refresh(self, name: str, build: Callable) -> asyncio.Task:
+        """Один пересчёт на отчёт: повторные запросы ждут уже запущенный"""
+        task = self.refreshing.get(name)
+        if task is None:
+            task = self.refreshing[name] = asyncio.ensure_future(self._build(name, build))
+        return task
+
+    async def _build(self, name: str, build: Callable):
+        try:
+            self.stale.discard(name)
+            started = time.time()
+            result = await build()
+            if result.status == "success":
+                self.cache[name] = (started, result)
+            else:
+                self.errors[name] = result
+        except Exception as e:
+            print(f"[REPORTS] Ошибка расчёта {name}: {e}")
+            self.errors[name] = ApiResponse.error(str(e))
+        finally:
+            self.refreshing.pop(name, None)
+
+    async def stats(self) -> Tuple[ApiResponse, Optional[float]]:
+        return await self.get("stats", stations.get_stats)
+
+reports = Lazy(ReportService)
+
+# ========== ЖУРНАЛ ==========
+class Journal:
+    """
+    Журнал JSON Lines: входящие обновления (u), записи и отмены (b, c) и состояния FSM (s).
+    Включается явно (JOURNAL_ENABLED). Из обновлений сохраняются только поля, нужные replay.py:
+    id пользователя и чата, текст команды, callback_data - без имён, username и прочих данных профиля.
+    Файлы journal-NNNNNN.jsonl ротируются по segment_bytes. Каждый сегмент начинается с контрольной
+    точки (ck) - записей LocalStorage всех станций и FSM на момент открытия, - поэтому для восстановления достаточно
+    последнего сегмента, а старые (сверх keep или старше retention_days) удаляются. Записи и отмены журналируются
+    только в режиме LOCAL: в остальных режимах источник истины - Google Script.
+    """
+    def __init__(self, directory: str = Config.JOURNAL_DIR, segment_bytes: int = Config.JOURNAL_SEGMENT_BYTES,
+                 keep: int = Config.JOURNAL_KEEP_SEGMENTS, retention_days: int = Config.JOURNAL_RETENTION_DAYS):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.keep = keep
+        self.retention = retention_days * 86400
+        self.record_bookings = Config.MODE == "LOCAL"
+        self.file = None
+        self.written = 0
+        self.fsm: Optional[MemoryStorage] = None
+
+    def segments(self) -> List[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted(n for n in os.listdir(self.directory) if n.startswith("journal-") and n.endswith(".jsonl"))
+        return [os.path.join(self.directory, n) for n in names]
+
+    @staticmethod
+    def read(path: str):
+        """Записи сегмента; оборванная при падении последняя строка пропускается"""
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+    def records(self, since_checkpoint: bool = False):
+        """Все записи по порядку; с since_checkpoint - начиная с последней целой контрольной точки"""
+        paths = self.segments()
+        if since_checkpoint:
+            for i in range(len(paths) - 1, -1, -1):
+                first = next(self.read(paths[i]), None)
+                if first and first.get("k") == "ck":
+                    paths = paths[i:]
+                    break
+            else:
+                paths = []
+        for path in paths:
+            yield from self.read(path)
+
+    # ----- запись -----
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        paths = self.segments()
+        number = int(os.path.basename(paths[-1])[8:-6]) + 1 if paths else 1
+        if self.file:
+            self.file.close()
+        # Буферизация по строкам: каждая запись попадает в файл сразу
+        self.file = open(os.path.join(self.directory, f"journal-{number:06d}.jsonl"), "a",
+                         encoding="utf-8", buffering=1)
+        self.written = 0
+        self.file.write(self._line("ck", self._checkpoint()))
+        # Новый сегмент начинается с контрольной точки - предыдущие для восстановления не нужны
+        expired = time.time() - self.retention
+        excess = max(0, len(paths) + 1 - self.keep)
+        for i, path in enumerate(paths):
+            try:
+                if i < excess or os.path.getmtime(path) < expired:
+                    os.remove(path)
+            except OSError:
+                continue
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    @staticmethod
+    def _line(kind: str, data) -> str:
+        payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=str)
+        return f'{{"t":{time.time():.3f},"k":"{kind}","d":{payload}}}\n'
+
+    def _append(self, kind: str, data=None):
+        if not self.file:
+            return
+        line = self._line(kind, data)
+        self.file.write(line)
+        self.written += len(line)
+        if self.written >= self.segment_bytes:
+            self.open()
+
+    def _checkpoint(self) -> Dict:
+        bookings = {}
+        if self.record_bookings:
+            for adapter in stations.adapters.values():
+                bookings[adapter.station] = [
+                    [b.ticket_number, b.date_ordinal, b.minute, b.blood_index, b.user_id, b.created_at]
+                    for b in adapter.local.tickets.values()]
+        fsm = []
+        if self.fsm is not None:
+            fsm = [[k.bot_id, k.chat_id, k.user_id, r.state, r.data]
+                   for k, r in self.fsm.storage.items() if r.state or r.data]
+        return {"bookings": bookings, "fsm": fsm}
+
+    def record_update(self, update: types.Update):
+        if self.file:
+            self._append("u", self._minimal_update(update))
+
+    @staticmethod
+    def _minimal_update(update: types.Update) -> Dict:
+        """
+        Обновление без данных профиля: ровно то, что нужно обработчикам при воспроизведении.
+        Бот отвечает только на команды, поэтому текст остальных сообщений не сохраняется.
+        """
+        def sender(user: Optional[types.User]) -> Dict:
+            return {"id": user.id, "is_bot": user.is_bot, "first_name": ""} if user else {}
+
+        def chat(c: types.Chat) -> Dict:
+            return {"id": c.id, "type": c.type}
+
+        result: Dict[str, Any] = {"update_id": update.update_id}
+        message = update.message
+        if message:
+            is_command = bool(message.text and message.text.startswith("/"))
+            result["message"] = {"message_id": message.message_id, "date": int(message.date.timestamp()),
+                                 "chat": chat(message.chat), "from": sender(message.from_user),
+                                 "text": message.text if is_command else None,
+                                 "entities": [e.model_dump(exclude_none=True) for e in message.entities or []]
+                                 if is_command else []}
+        query = update.callback_query
+        if query:
+            result["callback_query"] = {"id": query.id, "chat_instance": query.chat_instance, "data": query.data,
+                                        "from": sender(query.from_user)}
+            if query.message:
+                result["callback_query"]["message"] = {
+                    "message_id": query.message.message_id, "date": int(query.message.date.timestamp()),
+                    "chat": chat(query.message.chat), "text": ""}
+        return result
+
+    def record_fsm(self, key: StorageKey, record: MemoryStorageRecord):
+        self._append("s", [key.bot_id, key.chat_id, key.user_id, record.state, record.data])
+
+    def on_storage_event(self, event: str, payload: Dict):
+        if not self.record_bookings:
+            return
+        if event == "booked":
+            self._append("b", [payload["ticket"], payload["date"], payload["time"],
+                               payload["blood_group"], payload["user_id"], payload["station"]])
+        elif event == "cancelled":
+            self._append("c", [payload["ticket"], payload["station"]])
+
+    # ----- восстановление -----
+    def restore(self, fsm: Optional[MemoryStorage]) -> int:
+        """Восстанавливает записи станций, FSM и активность сессий; возвращает число применённых записей"""
+        applied = 0
+        for record in self.records(since_checkpoint=True):
+            kind, data = record.get("k"), record.get("d")
+            if kind == "ck":
+                self.apply_checkpoint(data, fsm)
+            elif kind == "b" and self.record_bookings:
+                ticket, date, time_slot, blood_group, user_id, station = data
+                number = TicketIssuer.parse(ticket)
+                if number is not None:
+                    self._restore_booking(stations.backend(station).local, Booking.create(
+                        number, date, time_slot, blood_group, user_id, int(record["t"])))
+            elif kind == "c" and self.record_bookings:
+                local = stations.backend(data[1]).local
+                booking = local.tickets.get(TicketIssuer.parse(data[0]))
+                if booking:
+                    local._remove_booking_sync(booking)
+            elif kind == "s" and fsm is not None:
+                self._restore_fsm(fsm, *data)
+            elif kind == "u":
+                user_id = self.update_user_id(data)
+                if user_id:
+                    session_timeout.update(user_id, record["t"])
+            applied += 1
+        return applied
+
+    def apply_checkpoint(self, data: Dict, fsm: Optional[MemoryStorage]):
+        """Заменяет записи станций и FSM срезом из контрольной точки"""
+        if self.record_bookings:
+            for adapter in stations.adapters.values():
+                adapter.local._clear_sync()
+            for station, bookings in data["bookings"].items():
+                local = stations.backend(station).local
+                for fields in bookings:
+                    self._restore_booking(local, Booking(*fields))
+        if fsm is not None:
+            fsm.storage.clear()
+            for fields in data["fsm"]:
+                self._restore_fsm(fsm, *fields)
+
+    @staticmethod
+    def _restore_booking(local: LocalStorage, booking: Booking):
+        local._insert_booking_sync(booking)
+        local.ticket_issuer.observe(booking.ticket)
+
+    @staticmethod
+    def _restore_fsm(fsm: MemoryStorage, bot_id: int, chat_id: int, user_id: int, state: Optional[str], data: Dict):
+        key = StorageKey(bot_id=bot_id, chat_id=chat_id, user_id=user_id)
+        if state or data:
+            fsm.storage[key] = MemoryStorageRecord(data=data, state=state)
+        else:
+            fsm.storage.pop(key, None)
+
+    @staticmethod
+    def update_user_id(update: Dict) -> Optional[int]:
+        for kind in ("message", "callback_query", "edited_message"):
+            sender = update.get(kind, {}).get("from")
+            if sender:
+                return sender.get("id")
+        return None
+
+journal = Lazy(Journal)
+
+class JournaledStorage(MemoryStorage):
+    """MemoryStorage, который пишет в журнал каждое изменение состояния и данных FSM"""
+    def __init__(self, journal: Journal):
+        super().__init__()
+        self.journal = journal
+        journal.fsm = self
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        before = self.storage[key].state
+        await super().set_state(key, state)
+        if self.storage[key].state != before:
+            self.journal.record_fsm(key, self.storage[key])
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        if self.storage[key].data != data:
+            await super().set_data(key, data)
+            self.journal.record_fsm(key, self.storage[key])
 
 # ========== СОСТОЯНИЯ ==========
 class Form(StatesGroup):
+    waiting_for_station = State()
     waiting_for_blood_group = State()
     waiting_for_date = State()
     waiting_for_time = State()
@@ -441,12 +2412,8 @@ class Form(StatesGroup):
 # ========== КЛАВИАТУРЫ ==========
 def get_blood_group_keyboard() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
-    groups = [
-        ("🅰️ A+", f"{CallbackData.BLOOD_PREFIX}A+"), ("🅰️ A-", f"{CallbackData.BLOOD_PREFIX}A-"),
-        ("🅱️ B+", f"{CallbackData.BLOOD_PREFIX}B+"), ("🅱️ B-", f"{CallbackData.BLOOD_PREFIX}B-"),
-        ("🆎 AB+", f"{CallbackData.BLOOD_PREFIX}AB+"), ("🆎 AB-", f"{CallbackData.BLOOD_PREFIX}AB-"),
-        ("🅾️ O+", f"{CallbackData.BLOOD_PREFIX}O+"), ("🅾️ O-", f"{CallbackData.BLOOD_PREFIX}O-")
-    ]
+    icons = {"A": "🅰️", "B": "🅱️", "AB": "🆎", "O": "🅾️"}
+    groups = [(f"{icons[g[:-1]]} {g}", CallbackCodec.encode(CallbackAction.BLOOD, g)) for g in BLOOD_GROUPS]
     for i in range(0, len(groups), 2):
         builder.row(*[InlineKeyboardButton(text=t, callback_data=d) for t, d in groups[i:i+2]])
     builder.row(
@@ -455,15 +2422,24 @@ def get_blood_group_keyboard() -> InlineKeyboardMarkup:
     )
     return builder.as_markup()
 
-def get_dates_keyboard(dates: List[dict]) -> InlineKeyboardMarkup:
+def add_waitlist_row(builder: InlineKeyboardBuilder, waitlist_for: Optional[Tuple[str, str, int]]):
+    """waitlist_for - (дата, группа крови, код станции) для кнопки листа ожидания"""
+    if waitlist_for:
+        builder.row(InlineKeyboardButton(
+            text="🔔 Встать в лист ожидания",
+            callback_data=CallbackCodec.encode(CallbackAction.WAITLIST_JOIN, *waitlist_for)
+        ))
+
+def get_dates_keyboard(dates: List[dict], waitlist_for: Optional[Tuple[str, str, int]] = None) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
+    add_waitlist_row(builder, waitlist_for)
     if not dates:
         builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data=CallbackData.BACK_TO_BLOOD))
         return builder.as_markup()
     for d in dates:
         builder.row(InlineKeyboardButton(
             text=f"{d['day_of_week']}\n{d['display_date']}",
-            callback_data=f"{CallbackData.DATE_PREFIX}{d['date']}"
+            callback_data=CallbackCodec.encode(CallbackAction.DATE, d['date'])
         ))
     builder.row(
         InlineKeyboardButton(text="🔙 Назад", callback_data=CallbackData.BACK_TO_BLOOD),
@@ -471,12 +2447,13 @@ def get_dates_keyboard(dates: List[dict]) -> InlineKeyboardMarkup:
     )
     return builder.as_markup()
 
-def get_times_keyboard(times: List[str]) -> InlineKeyboardMarkup:
+def get_times_keyboard(times: List[str], waitlist_for: Optional[Tuple[str, str, int]] = None) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
+    add_waitlist_row(builder, waitlist_for)
     if not times:
         builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data=CallbackData.BACK_TO_DATE))
         return builder.as_markup()
-    buttons = [InlineKeyboardButton(text=f"⏰ {t}", callback_data=f"{CallbackData.TIME_PREFIX}{t}") for t in times]
+    buttons = [InlineKeyboardButton(text=f"⏰ {t}", callback_data=CallbackCodec.encode(CallbackAction.TIME, t)) for t in times]
     for i in range(0, len(buttons), 3):
         builder.row(*buttons[i:i+3])
     builder.row(
@@ -498,16 +2475,28 @@ def get_main_menu_keyboard() -> InlineKeyboardMarkup:
     )
     return builder.as_markup()
 
-def get_confirm_cancellation_keyboard(date: str, ticket: str) -> InlineKeyboardMarkup:
+def get_stations_keyboard() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    for station in stations.ids:
+        builder.row(InlineKeyboardButton(
+            text=f"🏥 {stations.name(station)}",
+            callback_data=CallbackCodec.encode(CallbackAction.STATION, stations.code(station))
+        ))
+    builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data=CallbackData.CANCEL))
+    return builder.as_markup()
+
+def get_confirm_cancellation_keyboard(date: str, ticket: str, station: int = 0) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(
-        InlineKeyboardButton(text="✅ Да, отменить", callback_data=f"{CallbackData.CANCEL_YES_PREFIX}{date}_{ticket}"),
+        InlineKeyboardButton(text="✅ Да, отменить",
+                             callback_data=CallbackCodec.encode(CallbackAction.CANCEL_YES, date, ticket, station)),
         InlineKeyboardButton(text="❌ Нет, оставить", callback_data=CallbackData.CANCEL_NO)
     )
     return builder.as_markup()
 
 def get_admin_keyboard() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
+    builder.row(InlineKeyboardButton(text="🔄 Обновить панель", callback_data=CallbackData.ADMIN_SHOW_QUOTAS))
     builder.row(
         InlineKeyboardButton(text="🗑️ Очистить кэш", callback_data=CallbackData.ADMIN_CLEAR_CACHE),
         InlineKeyboardButton(text="🔄 Обновить кэш", callback_data=CallbackData.ADMIN_REFRESH_CACHE)
@@ -515,67 +2504,114 @@ def get_admin_keyboard() -> InlineKeyboardMarkup:
     builder.row(InlineKeyboardButton(text="🔙 В главное меню", callback_data=CallbackData.MAIN_MENU))
     return builder.as_markup()
 
-# ========== MIDDLEWARE ДЛЯ ТАЙМАУТА ==========
-async def timeout_middleware(handler, event, data):
+# ========== MIDDLEWARE ==========
+@dataclass(frozen=True, slots=True)
+class UserContext:
+    """Кто и откуда прислал обновление; вычисляется один раз и передаётся дальше по цепочке как data['user_ctx']"""
+    user_id: Optional[int]
+    chat_id: Optional[int]
+    callback: Optional[CallbackQuery] = None
+
+def extract_user_context(event: Update, data: Dict[str, Any]) -> UserContext:
+    # Пользователя и чат уже нашёл встроенный UserContextMiddleware aiogram - повторно Update не разбираем
+    user = data.get("event_from_user")
+    chat = data.get("event_chat")
+    return UserContext(user.id if user else None, chat.id if chat else None, event.callback_query)
+
+async def user_context_middleware(handler, event: Update, data: Dict[str, Any]):
+    data["user_ctx"] = extract_user_context(event, data)
+    return await handler(event, data)
+
+async def timeout_middleware(handler, event: Update, data: Dict[str, Any]):
+    # user_ctx кладёт user_context_middleware, он стоит в цепочке раньше
+    ctx: UserContext = data["user_ctx"]
+    if ctx.user_id is None or not session_timeout.touch(ctx.user_id):
+        return await handler(event, data)
+
     try:
-        user_id = None
-        chat_id = None
-
-        if hasattr(event, 'from_user') and event.from_user:
-            user_id = event.from_user.id
-            chat_id = event.chat.id if hasattr(event, 'chat') and event.chat else None
-        elif hasattr(event, 'message') and event.message and event.message.from_user:
-            user_id = event.message.from_user.id
-            chat_id = event.message.chat.id
-        elif hasattr(event, 'callback_query') and event.callback_query and event.callback_query.from_user:
-            user_id = event.callback_query.from_user.id
-            if hasattr(event.callback_query, 'message') and event.callback_query.message:
-                chat_id = event.callback_query.message.chat.id
-
-        if user_id:
-            if session_timeout.is_expired(user_id):
-                print(f"[TIMEOUT] Сессия пользователя {user_id} истекла")
-                state = data.get('state')
-                if state:
-                    await state.clear()
-                session_timeout.clear(user_id)
-
-                # Игнорируем таймаут для кнопки главного меню
-                is_main_menu = False
-                if hasattr(event, 'callback_query') and event.callback_query:
-                    if hasattr(event.callback_query, 'data') and event.callback_query.data == CallbackData.MAIN_MENU:
-                        is_main_menu = True
-
-                if is_main_menu:
-                    session_timeout.update(user_id)
-                    return await handler(event, data)
-
-                bot = data.get('bot')
-                if bot and chat_id:
-                    try:
-                        await bot.send_message(
-                            chat_id=chat_id,
-                            text="⏳ Ваша сессия истекла. Используйте /start",
-                            reply_markup=get_main_menu_keyboard()
-                        )
-                    except:
-                        pass
-
-                if hasattr(event, 'callback_query'):
-                    try:
-                        await event.callback_query.answer("Сессия истекла", show_alert=True)
-                    except:
-                        pass
-                return False
+        print(f"[TIMEOUT] Сессия пользователя {ctx.user_id} истекла")
+        state = data.get('state')
+        if state:
+            await release_hold(state, ctx.user_id)
+            await state.clear()
+
+        # Игнорируем таймаут для кнопки главного меню
+        if ctx.callback and ctx.callback.data == CallbackData.MAIN_MENU:
+            session_timeout.update(ctx.user_id)
+            return await handler(event, data)
 
-            session_timeout.update(user_id)
+        if ctx.callback:
+            await outbox.ack(ctx.callback, "Сессия истекла", show_alert=True)
+
+        bot = data.get('bot')
+        if bot and ctx.chat_id:
+            outbox.send(ctx.chat_id, lambda: bot.send_message(
+                chat_id=ctx.chat_id,
+                text="⏳ Ваша сессия истекла. Используйте /start",
+                reply_markup=get_main_menu_keyboard()
+            ))
+        return False
     except Exception as e:
         print(f"[TIMEOUT] Ошибка: {e}")
     return await handler(event, data)
 
+class MiddlewareProfiler:
+    """
+    Собственное время каждого middleware цепочки update: из полного времени вычитается время
+    вложенного вызова handler. Время самой маршрутизации и обработчиков учитывается отдельной строкой.
+    """
+    HANDLERS = "обработчики"
+
+    def __init__(self):
+        self.stats: Dict[str, LatencyStats] = {}
+
+    def wrap(self, middleware, innermost: bool = False):
+        stats = self.stats.setdefault(middleware.__name__, LatencyStats())
+        handler_stats = self.stats.setdefault(self.HANDLERS, LatencyStats()) if innermost else None
+
+        async def profiled(handler, event, data):
+            nested = 0.0
+
+            async def timed_handler(event, data):
+                nonlocal nested
+                start = time.perf_counter()
+                ok = False
+                try:
+                    result = await handler(event, data)
+                    ok = True
+                    return result
+                finally:
+                    nested += time.perf_counter() - start
+                    if handler_stats is not None:
+                        handler_stats.record(nested * 1000, ok)
+
+            start = time.perf_counter()
+            ok = False
+            try:
+                result = await middleware(timed_handler, event, data)
+                ok = True
+                return result
+            finally:
+                stats.record((time.perf_counter() - start - nested) * 1000, ok)
+
+        return profiled
+
+    def install(self, observer, middlewares: List[Callable]):
+        for i, middleware in enumerate(middlewares):
+            observer.middleware(self.wrap(middleware, innermost=i == len(middlewares) - 1))
+
+    def render(self) -> List[str]:
+        return [f"  • `{name}`: ср. {s.mean_ms * 1000:.0f} мкс, макс {s.max_ms * 1000:.0f} мкс, {s.count} обн."
+                for name, s in self.stats.items()]
+
+middleware_profiler = Lazy(MiddlewareProfiler)
+
 # ========== УНИВЕРСАЛЬНЫЕ ФУНКЦИИ ДЛЯ ИЗВЛЕЧЕНИЯ ==========
 def extract_blood_group(callback_data: str) -> Optional[str]:
     """Извлекает группу крови из callback_data любого формата"""
+    args = decode_callback(callback_data, CallbackAction.BLOOD)
+    if args:
+        return args[0]
     if callback_data.startswith('blood_'):
         return callback_data[6:]
     if callback_data.startswith('CallbackData.BLOOD_PREFIX'):
@@ -587,6 +2623,9 @@ def extract_blood_group(callback_data: str) -> Optional[str]:
 
 def extract_date(callback_data: str) -> Optional[str]:
     """Извлекает дату из callback_data любого формата"""
+    args = decode_callback(callback_data, CallbackAction.DATE)
+    if args:
+        return args[0]
     if callback_data.startswith('date_'):
         return callback_data[5:]
     if callback_data.startswith('CallbackData.DATE_PREFIX'):
@@ -595,6 +2634,9 @@ def extract_date(callback_data: str) -> Optional[str]:
 
 def extract_time(callback_data: str) -> Optional[str]:
     """Извлекает время из callback_data любого формата"""
+    args = decode_callback(callback_data, CallbackAction.TIME)
+    if args:
+        return args[0]
     if callback_data.startswith('time_'):
         return callback_data[5:]
     if callback_data.startswith('CallbackData.TIME_PREFIX'):
@@ -605,46 +2647,50 @@ def extract_main_menu(callback_data: str) -> bool:
     """Проверяет, является ли callback_data командой главного меню"""
     return callback_data in (CallbackData.MAIN_MENU, 'CallbackData.MAIN_MENU', 'main_menu')
 
+def extract_cancel(callback_data: str, action: CallbackAction) -> Optional[Tuple[str, str, int]]:
+    """Извлекает (дату, талон, код станции) из callback_data отмены; поддерживает старый формат cancel_ask_/cancel_yes_"""
+    args = decode_callback(callback_data, action)
+    if args:
+        return args
+    prefix = CallbackData.CANCEL_YES_PREFIX if action == CallbackAction.CANCEL_YES else CallbackData.CANCEL_ASK_PREFIX
+    if callback_data.startswith(prefix.value):
+        date, sep, ticket = callback_data[len(prefix.value):].partition("_")
+        if sep and ticket:
+            return date, ticket, 0
+    return None
+
 # ========== ОБРАБОТЧИКИ ==========
 async def start_command(message: types.Message, state: FSMContext):
     user = message.from_user
     if not rate_limiter.is_allowed(user.id):
-        return await message.answer("⏳ Слишком много запросов")
+        outbox.answer(message, "⏳ Слишком много запросов")
+        return
 
     await state.clear()
-    session_timeout.update(user.id)
 
     if Config.MODE in ["GOOGLE", "HYBRID"]:
-        storage.clear_cache()
+        stations.clear_cache()
 
     text = (f"🎯 *Донорская станция v5.3*\n"
             f"👋 Привет, {user.first_name or 'пользователь'}!\n\n"
             f"Я помогу вам записаться на донорство крови.\n"
             f"*Выберите действие:*")
 
-    await message.answer(text, parse_mode="Markdown", reply_markup=get_main_menu_keyboard())
+    outbox.answer(message, text, parse_mode="Markdown", reply_markup=get_main_menu_keyboard())
 
 async def process_main_menu(callback: CallbackQuery, state: FSMContext):
     user = callback.from_user
-    session_timeout.update(user.id)
-
-    if callback.data == CallbackData.MAIN_RECORD:
-        await callback.message.edit_text(
-            "🩸 *Выберите вашу группу крови:*",
-            parse_mode="Markdown",
-            reply_markup=get_blood_group_keyboard()
-        )
-        await state.set_state(Form.waiting_for_blood_group)
-        await state.update_data(is_check=False)
-
-    elif callback.data == CallbackData.MAIN_CHECK:
-        await callback.message.edit_text(
-            "🔍 *Проверка времени*\nВыберите группу крови:",
-            parse_mode="Markdown",
-            reply_markup=get_blood_group_keyboard()
-        )
-        await state.set_state(Form.waiting_for_blood_group)
-        await state.update_data(is_check=True)
+    await outbox.ack(callback)
+
+    if callback.data in (CallbackData.MAIN_RECORD, CallbackData.MAIN_CHECK):
+        is_check = callback.data == CallbackData.MAIN_CHECK
+        if stations.multiple:
+            await state.set_state(Form.waiting_for_station)
+            await state.update_data(is_check=is_check)
+            outbox.edit_text(callback.message, "🏥 *Выберите станцию:*", parse_mode="Markdown",
+                             reply_markup=get_stations_keyboard())
+        else:
+            await ask_blood_group(callback, state, stations.default, is_check)
 
     elif callback.data == CallbackData.MAIN_MYBOOKINGS:
         await show_my_bookings(callback.message, user)
@@ -655,106 +2701,124 @@ async def process_main_menu(callback: CallbackQuery, state: FSMContext):
     elif callback.data == CallbackData.MAIN_HELP:
         await help_command(callback.message)
 
-    await callback.answer()
+async def ask_blood_group(callback: CallbackQuery, state: FSMContext, station: str, is_check: bool):
+    place = f"🏥 {stations.name(station)}\n" if stations.multiple else ""
+    text = f"🔍 *Проверка времени*\n{place}Выберите группу крови:" if is_check else f"{place}🩸 *Выберите вашу группу крови:*"
+    outbox.edit_text(callback.message, text, parse_mode="Markdown", reply_markup=get_blood_group_keyboard())
+    await state.set_state(Form.waiting_for_blood_group)
+    await state.update_data(is_check=is_check, station=station)
+    # Даты не зависят от группы крови - прогреваем кэш, пока пользователь выбирает
+    backend = stations.backend(station)
+    backend.prefetch("get_available_dates", callback.from_user.id)
+
+async def process_station(callback: CallbackQuery, state: FSMContext):
+    await outbox.ack(callback)
+    if callback.data == CallbackData.CANCEL:
+        await cancel_command(callback.message, state)
+        return
+    args = decode_callback(callback.data, CallbackAction.STATION)
+    if not args:
+        return
+    data = await state.get_data()
+    await ask_blood_group(callback, state, stations.by_code(args[0]), data.get('is_check', False))
 
 async def process_blood_group(callback: CallbackQuery, state: FSMContext):
     user = callback.from_user
-    session_timeout.update(user.id)
 
     print(f"🔍 DIAG: process_blood_group вызван с callback.data = '{callback.data}'")
 
     if callback.data == CallbackData.CANCEL:
+        await outbox.ack(callback)
         await cancel_command(callback.message, state)
-        await callback.answer()
         return
 
     if callback.data == CallbackData.MAIN_MENU or extract_main_menu(callback.data):
+        await outbox.ack(callback)
         await show_main_menu(callback.message)
         await state.clear()
-        await callback.answer()
         return
 
     if callback.data == CallbackData.BACK_TO_BLOOD:
-        await callback.answer()
+        await outbox.ack(callback)
         return
 
     blood = extract_blood_group(callback.data)
     if not blood:
         print(f"❌ DIAG: не удалось извлечь группу крови из '{callback.data}'")
-        await callback.answer("Пожалуйста, выберите группу крови", show_alert=True)
+        await outbox.ack(callback, "Пожалуйста, выберите группу крови", show_alert=True)
         return
 
     print(f"✅ DIAG: извлечена группа крови: '{blood}'")
-    await state.update_data(blood_group=blood)
-
-    data = await state.get_data()
+    await outbox.ack(callback)
+    data = await state.update_data(blood_group=blood)
     is_check = data.get('is_check', False)
+    backend = stations.backend(data.get('station'))
 
-    resp = await storage.get_available_dates(user.id)
+    # Если прогрев из ask_blood_group ещё в полёте - ждём его, а не отправляем второй запрос
+    resp, = await backend.gather(backend.shared("get_available_dates", user.id))
 
     if resp.status == 'error':
-        await callback.message.edit_text(
+        outbox.edit_text(
+            callback.message,
             f"❌ Ошибка: {resp.data}",
             reply_markup=get_main_menu_keyboard()
         )
         await state.clear()
-        await callback.answer()
         return
 
     dates = resp.data.get('available_dates', [])
     if not dates:
-        await callback.message.edit_text(
+        outbox.edit_text(
+            callback.message,
             "😔 Нет доступных дат",
             reply_markup=get_main_menu_keyboard()
         )
         await state.clear()
-        await callback.answer()
         return
 
     action = "проверки" if is_check else "записи"
     text = f"📅 *Выберите дату для {action}:*\n🩸 Группа: {blood}"
 
-    await callback.message.edit_text(
-        text, parse_mode="Markdown", reply_markup=get_dates_keyboard(dates)
+    outbox.edit_text(
+        callback.message, text, parse_mode="Markdown", reply_markup=get_dates_keyboard(dates)
     )
     await state.set_state(Form.waiting_for_date)
-    await callback.answer()
 
 async def process_date(callback: CallbackQuery, state: FSMContext):
     user = callback.from_user
-    session_timeout.update(user.id)
 
     print(f"🔍 DIAG: process_date вызван с callback.data = '{callback.data}'")
 
     if callback.data == CallbackData.CANCEL:
+        await outbox.ack(callback)
         await cancel_command(callback.message, state)
-        await callback.answer()
         return
 
     if callback.data == CallbackData.BACK_TO_BLOOD:
-        await callback.message.edit_text(
+        await outbox.ack(callback)
+        outbox.edit_text(
+            callback.message,
             "🩸 Выберите группу крови:",
             reply_markup=get_blood_group_keyboard()
         )
         await state.set_state(Form.waiting_for_blood_group)
-        await callback.answer()
         return
 
     date = extract_date(callback.data)
     if not date:
         print(f"❌ DIAG: не удалось извлечь дату из '{callback.data}'")
-        await callback.answer("Выберите дату", show_alert=True)
+        await outbox.ack(callback, "Выберите дату", show_alert=True)
         return
 
     print(f"✅ DIAG: извлечена дата: '{date}'")
+    await outbox.ack(callback)
 
     data = await state.get_data()
     blood = data.get('blood_group')
 
     if not blood:
-        await callback.message.edit_text("❌ Ошибка", reply_markup=get_main_menu_keyboard())
+        outbox.edit_text(callback.message, "❌ Ошибка", reply_markup=get_main_menu_keyboard())
         await state.clear()
-        await callback.answer()
         return
 
     await state.update_data(selected_date=date)
@@ -762,92 +2826,112 @@ async def process_date(callback: CallbackQuery, state: FSMContext):
     try:
         d_obj = datetime.strptime(date, "%Y-%m-%d")
         display = d_obj.strftime("%d.%m.%Y")
-        day = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"][d_obj.weekday()]
+        day = WEEKDAYS_RU[d_obj.weekday()]
     except:
         display, day = date, "?"
 
-    resp = await storage.get_free_times(date, blood)
+    is_check = data.get('is_check', False)
+    station = data.get('station')
+    backend = stations.backend(station)
+    if is_check:
+        resp, = await backend.gather(backend.get_free_times(date, blood, user.id))
+    else:
+        # Список дат понадобится, если на выбранную дату всё занято - запрашиваем параллельно
+        resp, dates_resp = await backend.gather(
+            backend.get_free_times(date, blood, user.id), backend.get_available_dates(user.id)
+        )
 
     if resp.status == 'error':
-        await callback.message.edit_text(f"❌ {resp.data}", reply_markup=get_main_menu_keyboard())
-        await callback.answer()
+        outbox.edit_text(callback.message, f"❌ {resp.data}", reply_markup=get_main_menu_keyboard())
         return
 
     times = resp.data.get('times', [])
     quota = resp.data.get('quota', 0)
-    is_check = data.get('is_check', False)
 
     if not times:
         if is_check:
-            await callback.message.edit_text(
+            outbox.edit_text(
+                callback.message,
                 f"📅 На {display} ({day}) для {blood} все заняты\n📊 Осталось: {quota}",
                 reply_markup=get_main_menu_keyboard()
             )
             await state.clear()
         else:
-            dates_resp = await storage.get_available_dates(user.id)
             dates = dates_resp.data.get('available_dates', []) if dates_resp.status == 'success' else []
-            await callback.message.edit_text(
-                f"❌ На {display} все заняты\nВыберите другую дату:",
-                reply_markup=get_dates_keyboard(dates)
+            outbox.edit_text(
+                callback.message,
+                f"❌ На {display} все заняты\nВыберите другую дату или встаньте в лист ожидания:",
+                reply_markup=get_dates_keyboard(dates, waitlist_for=(date, blood, stations.code(station)))
             )
-        await callback.answer()
         return
 
     if is_check:
         text = f"📅 *Доступное время на {display}:*\n📋 {day}\n🩸 {blood}\n📊 Свободно {len(times)} из {quota}\n\n"
         text += "\n".join(f"• {t}" for t in times)
-        await callback.message.edit_text(text, parse_mode="Markdown", reply_markup=get_main_menu_keyboard())
+        outbox.edit_text(callback.message, text, parse_mode="Markdown", reply_markup=get_main_menu_keyboard())
         await state.clear()
     else:
-        await callback.message.edit_text(
+        # Место держится за донором, пока он выбирает время: другим оно не показывается
+        backend.holds.hold(date, blood, user.id)
+        # Версия слота, которую видел именно этот донор, - по ней register поймает изменения до записи
+        await state.update_data(slot_version=resp.data.get('version'))
+        outbox.edit_text(
+            callback.message,
             f"✅ *Доступное время на {display}:*\n📊 Свободно {quota} мест\n\nВыберите время:",
             parse_mode="Markdown", reply_markup=get_times_keyboard(times)
         )
         await state.set_state(Form.waiting_for_time)
 
-    await callback.answer()
+async def release_hold(state: FSMContext, user_id: int):
+    """Донор ушёл с выбора времени - удержанное место сразу возвращается в квоту, не дожидаясь ttl"""
+    data = await state.get_data()
+    stations.backend(data.get('station')).holds.release(user_id)
 
 async def process_time(callback: CallbackQuery, state: FSMContext):
     user = callback.from_user
-    session_timeout.update(user.id)
 
     print(f"🔍 DIAG: process_time вызван с callback.data = '{callback.data}'")
 
     if callback.data == CallbackData.CANCEL:
+        await outbox.ack(callback)
+        await release_hold(state, user.id)
         await cancel_command(callback.message, state)
-        await callback.answer()
         return
 
     if callback.data == CallbackData.BACK_TO_DATE:
+        await outbox.ack(callback)
+        await release_hold(state, user.id)
         data = await state.get_data()
         blood = data.get('blood_group')
-        resp = await storage.get_available_dates(user.id)
+        resp = await stations.backend(data.get('station')).get_available_dates(user.id)
         dates = resp.data.get('available_dates', []) if resp.status == 'success' else []
-        await callback.message.edit_text(
+        outbox.edit_text(
+            callback.message,
             f"📅 Выберите дату:\n🩸 {blood}",
             reply_markup=get_dates_keyboard(dates)
         )
         await state.set_state(Form.waiting_for_date)
-        await callback.answer()
         return
 
     time_val = extract_time(callback.data)
     if not time_val:
         print(f"❌ DIAG: не удалось извлечь время из '{callback.data}'")
-        await callback.answer("Выберите время", show_alert=True)
+        await outbox.ack(callback, "Выберите время", show_alert=True)
         return
 
     print(f"✅ DIAG: извлечено время: '{time_val}'")
+    # Дальше результат показывается только в сообщении - "часики" снимаем до запросов к backend
+    await outbox.ack(callback)
 
     data = await state.get_data()
     date = data.get('selected_date')
     blood = data.get('blood_group')
+    station = data.get('station')
+    backend = stations.backend(station)
 
     if not date or not blood:
-        await callback.message.edit_text("❌ Ошибка", reply_markup=get_main_menu_keyboard())
+        outbox.edit_text(callback.message, "❌ Ошибка", reply_markup=get_main_menu_keyboard())
         await state.clear()
-        await callback.answer()
         return
 
     try:
@@ -855,89 +2939,118 @@ async def process_time(callback: CallbackQuery, state: FSMContext):
     except:
         display = date
 
-    check = await storage.check_existing(date, user.id)
+    check = await stations.check_existing(date, user.id, station)
     if check.status == 'success' and check.data.get('exists'):
-        await callback.message.edit_text(
-            f"⚠️ У вас уже есть запись на {display}!",
+        place = f" ({stations.name(check.data['station'])})" if stations.multiple else ""
+        outbox.edit_text(
+            callback.message,
+            f"⚠️ У вас уже есть запись на {display}{place}!",
             reply_markup=get_main_menu_keyboard()
         )
         await state.clear()
-        await callback.answer()
         return
 
-    resp = await storage.register(date, blood, time_val, user.id)
+    resp = await backend.register(date, blood, time_val, user.id, data.get('slot_version'))
 
     if resp.status == 'error':
-        times_resp = await storage.get_free_times(date, blood)
+        times_resp = await backend.get_free_times(date, blood, user.id)
         times = times_resp.data.get('times', []) if times_resp.status == 'success' else []
-        await callback.message.edit_text(
+        if times_resp.status == 'success':
+            await state.update_data(slot_version=times_resp.data.get('version'))
+        quota_full = resp.data == "Все квоты заняты" or not times
+        outbox.edit_text(
+            callback.message,
             f"❌ {resp.data}\nВыберите другое время:",
-            reply_markup=get_times_keyboard(times)
+            reply_markup=get_times_keyboard(
+                times, waitlist_for=(date, blood, stations.code(station)) if quota_full else None)
         )
-        await callback.answer()
         return
 
     ticket_data = resp.data
 
-    # Обновляем квоту после регистрации
-    updated_times = await storage.get_free_times(date, blood)
-    if updated_times.status == 'success':
-        ticket_data['quota_remaining'] = updated_times.data.get('quota', 0)
-
-    text = (f"🎫 *ВАШ ТАЛОН*\n"
+    text = (f"✅ *Запись оформлена!*\n\n"
+            f"🎫 *ВАШ ТАЛОН*\n"
             f"• Номер: *{ticket_data.get('ticket', '?')}*\n"
             f"• Дата: *{display}*\n"
             f"• Время: *{ticket_data.get('time', '?')}*\n"
             f"• Группа: *{ticket_data.get('blood_group', '?')}*\n"
             f"📊 Осталось: *{ticket_data.get('quota_remaining', 0)}*")
 
-    await callback.message.edit_text(text, parse_mode="Markdown", reply_markup=get_main_menu_keyboard())
+    outbox.edit_text(callback.message, text, parse_mode="Markdown", reply_markup=get_main_menu_keyboard())
     await state.clear()
-    await callback.answer("✅ Запись оформлена!")
 
-async def show_my_bookings(message: types.Message, user: types.User):
-    resp = await storage.get_user_bookings(user.id)
+async def show_my_bookings(message: types.Message, user: types.User, archived: bool = False,
+                           cursor: Optional[str] = None, edit: bool = False):
+    """Страница записей: предстоящие с кнопками отмены или архив; edit - листание в том же сообщении"""
+    send = outbox.edit_text if edit else outbox.answer
+    resp = await stations.get_user_bookings(user.id, archived, cursor)
 
     if resp.status == 'error':
-        return await message.answer(f"❌ {resp.data}", reply_markup=get_main_menu_keyboard())
+        send(message, f"❌ {resp.data}", reply_markup=get_main_menu_keyboard())
+        return
 
     bookings = resp.data.get('bookings', [])
-    if not bookings:
-        return await message.answer(
-            f"📋 *Ваши записи*\n\nУ вас нет записей.",
-            parse_mode="Markdown", reply_markup=get_main_menu_keyboard()
-        )
-
+    archived_count = resp.data.get('archived_count', 0)
+    title = "🗂 *История записей*" if archived else "📋 *Ваши записи*"
     builder = InlineKeyboardBuilder()
-    text = f"📋 *Ваши записи*\n\n"
+    text = f"{title}\n\n"
+    if not bookings:
+        text += "Записей нет." if archived else "У вас нет предстоящих записей."
     for b in bookings:
         try:
             d = datetime.strptime(b['date'], "%Y-%m-%d").strftime("%d.%m.%Y")
         except:
             d = b['date']
-        text += f"• *{d}*: {b['time']} ({b['blood_group']})\n"
+        place = f", {stations.name(b['station'])}" if stations.multiple else ""
+        text += f"• *{d}*: {b['time']} ({b['blood_group']}{place})\n"
+        if not archived:
+            builder.row(InlineKeyboardButton(
+                text=f"❌ Отменить {d}",
+                callback_data=CallbackCodec.encode(
+                    CallbackAction.CANCEL_ASK, b['date'], b['ticket'], stations.code(b['station']))
+            ))
+
+    nav = []
+    if cursor:
+        nav.append(InlineKeyboardButton(
+            text="⏮ В начало", callback_data=CallbackCodec.encode(CallbackAction.BOOKINGS_PAGE, archived)))
+    if resp.data.get('next_cursor'):
+        nav.append(InlineKeyboardButton(
+            text="▶️ Далее",
+            callback_data=CallbackCodec.encode(CallbackAction.BOOKINGS_PAGE, archived, resp.data['next_cursor'])))
+    if nav:
+        builder.row(*nav)
+    if archived:
         builder.row(InlineKeyboardButton(
-            text=f"❌ Отменить {d}",
-            callback_data=f"{CallbackData.CANCEL_ASK_PREFIX}{b['date']}_{b['ticket']}"
-        ))
+            text="📋 Предстоящие", callback_data=CallbackCodec.encode(CallbackAction.BOOKINGS_PAGE, False)))
+    elif archived_count:
+        builder.row(InlineKeyboardButton(
+            text=f"🗂 История ({archived_count})", callback_data=CallbackCodec.encode(CallbackAction.BOOKINGS_PAGE, True)))
     builder.row(InlineKeyboardButton(text="🔙 В главное меню", callback_data=CallbackData.MAIN_MENU))
 
-    await message.answer(text, parse_mode="Markdown", reply_markup=builder.as_markup())
+    send(message, text, parse_mode="Markdown", reply_markup=builder.as_markup())
+
+async def process_bookings_page(callback: CallbackQuery, state: FSMContext):
+    await outbox.ack(callback)
+    archived, cursor = decode_callback(callback.data, CallbackAction.BOOKINGS_PAGE)
+    await show_my_bookings(callback.message, callback.from_user, archived, cursor, edit=True)
 
 async def show_stats(message: types.Message):
-    resp = await storage.get_stats()
+    resp, generated_at = await reports.stats()
 
     if resp.status == 'error':
-        return await message.answer(f"❌ {resp.data}", reply_markup=get_main_menu_keyboard())
+        outbox.answer(message, f"❌ {resp.data}", reply_markup=get_main_menu_keyboard())
+        return
 
     d = resp.data
     text = (f"📊 *Статистика*\n\n"
             f"👥 Пользователей: {d.get('total_users', 0)}\n"
             f"📝 Записей: {d.get('total_bookings', 0)}\n"
             f"📈 Популярный день: {d.get('most_popular_day', 'нет')}\n"
-            f"🩸 Популярная группа: {d.get('most_popular_blood_group', 'нет')}")
+            f"🩸 Популярная группа: {d.get('most_popular_blood_group', 'нет')}\n\n"
+            f"🕒 Данные на {datetime.fromtimestamp(generated_at).strftime('%H:%M:%S')}")
 
-    await message.answer(text, parse_mode="Markdown", reply_markup=get_main_menu_keyboard())
+    outbox.answer(message, text, parse_mode="Markdown", reply_markup=get_main_menu_keyboard())
 
 async def help_command(message: types.Message):
     text = ("📋 *Помощь*\n\n"
@@ -946,63 +3059,125 @@ async def help_command(message: types.Message):
             "• 📖 Мои записи\n"
             "• 📊 Статистика\n\n"
             "📌 Одна запись в день")
-    await message.answer(text, parse_mode="Markdown", reply_markup=get_main_menu_keyboard())
+    outbox.answer(message, text, parse_mode="Markdown", reply_markup=get_main_menu_keyboard())
 
 async def cancel_command(message: types.Message, state: FSMContext):
     await state.clear()
-    await message.answer("✅ Диалог отменен", reply_markup=get_main_menu_keyboard())
+    outbox.answer(message, "✅ Диалог отменен", reply_markup=get_main_menu_keyboard())
 
 async def show_main_menu(message: types.Message):
-    await message.answer("🎯 *Главное меню*", parse_mode="Markdown", reply_markup=get_main_menu_keyboard())
+    outbox.answer(message, "🎯 *Главное меню*", parse_mode="Markdown", reply_markup=get_main_menu_keyboard())
 
 # ========== СПЕЦИАЛЬНЫЙ ОБРАБОТЧИК ДЛЯ КНОПКИ ГЛАВНОГО МЕНЮ ==========
 async def process_main_menu_button(callback: CallbackQuery, state: FSMContext):
+    await outbox.ack(callback)
+    await release_hold(state, callback.from_user.id)
     await state.clear()
     await show_main_menu(callback.message)
-    await callback.answer()
 
 async def process_cancel_booking(callback: CallbackQuery, state: FSMContext):
     user = callback.from_user
-    session_timeout.update(user.id)
+    # Все ветки отвечают без текста - снимаем "часики" сразу
+    await outbox.ack(callback)
 
     if callback.data == CallbackData.CANCEL_NO:
-        await callback.message.edit_text("✅ Отмена отменена", reply_markup=get_main_menu_keyboard())
-        await callback.answer()
+        outbox.edit_text(callback.message, "✅ Отмена отменена", reply_markup=get_main_menu_keyboard())
         return
 
-    if callback.data.startswith(CallbackData.CANCEL_YES_PREFIX):
-        parts = callback.data.split("_")
-        if len(parts) >= 4:
-            date = parts[2]
-            ticket = "_".join(parts[3:])
-            resp = await storage.cancel_booking(date, ticket, user.id)
-            if resp.status == 'success':
-                await callback.message.edit_text("✅ Запись отменена", reply_markup=get_main_menu_keyboard())
-            else:
-                await callback.message.edit_text(f"❌ {resp.data}", reply_markup=get_main_menu_keyboard())
-        await callback.answer()
+    cancel_yes = extract_cancel(callback.data, CallbackAction.CANCEL_YES)
+    if cancel_yes:
+        date, ticket, station = cancel_yes
+        resp = await stations.backend(stations.by_code(station)).cancel_booking(date, ticket, user.id)
+        if resp.status == 'success':
+            outbox.edit_text(callback.message, "✅ Запись отменена", reply_markup=get_main_menu_keyboard())
+        else:
+            outbox.edit_text(callback.message, f"❌ {resp.data}", reply_markup=get_main_menu_keyboard())
         return
 
-    if callback.data.startswith(CallbackData.CANCEL_ASK_PREFIX):
-        parts = callback.data.split("_")
-        if len(parts) >= 4:
-            date = parts[2]
-            ticket = "_".join(parts[3:])
-            try:
-                d = datetime.strptime(date, "%Y-%m-%d").strftime("%d.%m.%Y")
-            except:
-                d = date
-            await callback.message.edit_text(
-                f"⚠️ Отменить запись на {d}?",
-                reply_markup=get_confirm_cancellation_keyboard(date, ticket)
-            )
-        await callback.answer()
+    cancel_ask = extract_cancel(callback.data, CallbackAction.CANCEL_ASK)
+    if cancel_ask:
+        date, ticket, station = cancel_ask
+        try:
+            d = datetime.strptime(date, "%Y-%m-%d").strftime("%d.%m.%Y")
+        except:
+            d = date
+        outbox.edit_text(
+            callback.message,
+            f"⚠️ Отменить запись на {d}?",
+            reply_markup=get_confirm_cancellation_keyboard(date, ticket, station)
+        )
+
+async def process_waitlist(callback: CallbackQuery, state: FSMContext):
+    user = callback.from_user
+    action, (date, blood, code) = CallbackCodec.decode(callback.data)
+    station = stations.by_code(code)
+    try:
+        display = datetime.strptime(date, "%Y-%m-%d").strftime("%d.%m.%Y")
+    except:
+        display = date
+
+    if action == CallbackAction.WAITLIST_JOIN:
+        position = waitlist.join(station, date, blood, user.id)
+        await outbox.ack(callback, f"🔔 Вы в листе ожидания, позиция {position}")
+        outbox.edit_text(
+            callback.message,
+            f"🔔 *Лист ожидания*\n📅 {display}\n🩸 {blood}\n📍 Позиция: {position}\n\n"
+            f"Напишем, как только место освободится.",
+            parse_mode="Markdown", reply_markup=get_main_menu_keyboard()
+        )
+        await state.clear()
+        return
+
+    if action == CallbackAction.WAITLIST_DECLINE:
+        await outbox.ack(callback)
+        waitlist.decline(user.id, station, date, blood)
+        outbox.edit_text(callback.message, "👌 Предложение отклонено", reply_markup=get_main_menu_keyboard())
+        return
+
+    if not waitlist.accept(user.id, station, date, blood):
+        await outbox.ack(callback, "⌛ Предложение уже истекло", show_alert=True)
+        return
+
+    await outbox.ack(callback)
+    backend = stations.backend(station)
+    resp = await backend.get_free_times(date, blood, user.id)
+    times = resp.data.get('times', []) if resp.status == 'success' else []
+    if not times:
+        outbox.edit_text(callback.message, "😔 Место уже заняли", reply_markup=get_main_menu_keyboard())
         return
 
-    # Если ни одно условие не подошло, просто отвечаем, чтобы callback не висел
-    await callback.answer()
+    backend.holds.hold(date, blood, user.id)
+
+    await state.set_state(Form.waiting_for_time)
+    await state.update_data(is_check=False, blood_group=blood, selected_date=date, station=station,
+                            slot_version=resp.data.get('version'))
+    outbox.edit_text(
+        callback.message,
+        f"✅ *Доступное время на {display}:*\n🩸 {blood}\n\nВыберите время:",
+        parse_mode="Markdown", reply_markup=get_times_keyboard(times)
+    )
+
+async def process_admin(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id not in Config.ADMIN_IDS:
+        await outbox.ack(callback, "⛔ Нет прав", show_alert=True)
+        return
+
+    if callback.data in (CallbackData.ADMIN_CLEAR_CACHE, CallbackData.ADMIN_RESET):
+        stations.clear_cache()
+        await outbox.ack(callback, "✅ Кэш очищен")
+    elif callback.data == CallbackData.ADMIN_REFRESH_CACHE:
+        await outbox.ack(callback, "🔄 Кэш будет обновлён при следующем запросе")
+    else:
+        await outbox.ack(callback)
+    outbox.edit_text(callback.message, dashboard.render(), parse_mode="Markdown", reply_markup=get_admin_keyboard())
 
 # ========== КОМАНДЫ ==========
+async def admin_command(message: types.Message, state: FSMContext):
+    if message.from_user.id not in Config.ADMIN_IDS:
+        outbox.answer(message, "⛔ Нет прав")
+        return
+    outbox.answer(message, dashboard.render(), parse_mode="Markdown", reply_markup=get_admin_keyboard())
+
 async def mybookings_command(message: types.Message, state: FSMContext):
     user = message.from_user
     await show_my_bookings(message, user)
@@ -1012,25 +3187,91 @@ async def stats_command(message: types.Message, state: FSMContext):
 
 async def reset_command(message: types.Message, state: FSMContext):
     if message.from_user.id not in Config.ADMIN_IDS:
-        await message.answer("⛔ Нет прав")
+        outbox.answer(message, "⛔ Нет прав")
         return
-    storage.clear_cache()
-    await message.answer("✅ Кэш очищен", reply_markup=get_main_menu_keyboard())
+    stations.clear_cache()
+    outbox.answer(message, "✅ Кэш очищен", reply_markup=get_main_menu_keyboard())
 
 async def clear_cache_command(message: types.Message, state: FSMContext):
     if message.from_user.id not in Config.ADMIN_IDS:
-        await message.answer("⛔ Нет прав")
+        outbox.answer(message, "⛔ Нет прав")
         return
-    storage.clear_cache()
-    await message.answer("✅ Кэш очищен", reply_markup=get_main_menu_keyboard())
+    stations.clear_cache()
+    outbox.answer(message, "✅ Кэш очищен", reply_markup=get_main_menu_keyboard())
 
 async def refresh_cache_command(message: types.Message, state: FSMContext):
     if message.from_user.id not in Config.ADMIN_IDS:
-        await message.answer("⛔ Нет прав")
+        outbox.answer(message, "⛔ Нет прав")
         return
-    await message.answer("🔄 Кэш будет обновлён при следующем запросе", reply_markup=get_main_menu_keyboard())
+    outbox.answer(message, "🔄 Кэш будет обновлён при следующем запросе", reply_markup=get_main_menu_keyboard())
 
 # ========== ЗАПУСК ==========
+startup_metrics: Dict[str, float] = {}
+
+async def first_update_middleware(handler, event, data):
+    try:
+        return await handler(event, data)
+    finally:
+        if "first_update_ms" not in startup_metrics:
+            startup_metrics["first_update_ms"] = (time.monotonic() - STARTED_AT) * 1000
+            print(f"[STARTUP] Первое обновление обработано через {startup_metrics['first_update_ms']:.0f} мс после старта")
+
+async def upstream_health_check(client: GoogleScriptClient, interval: float = Config.HEALTH_CHECK_INTERVAL):
+    """Фоновая проверка Google Script; результат отражается в client.circuit"""
+    while True:
+        test = await asyncio.to_thread(client.test_connection)
+        if test.status == "success":
+            print(f"[HEALTH] Google Script доступен (circuit: {client.circuit.state})")
+        else:
+            print(f"[HEALTH] Google Script недоступен: {test.data} (circuit: {client.circuit.state})")
+            if Config.MODE == "GOOGLE":
+                print("[HEALTH] Режим GOOGLE: запросы будут завершаться ошибкой, пока сервис не восстановится")
+        await asyncio.sleep(interval)
+
+async def journal_middleware(handler, event, data):
+    journal.record_update(event)
+    return await handler(event, data)
+
+def create_dispatcher(profile: bool = Config.PROFILE_MIDDLEWARE) -> Dispatcher:
+    dp = Dispatcher(storage=JournaledStorage(journal.get()) if Config.JOURNAL_ENABLED else MemoryStorage())
+
+    # Middleware
+    middlewares = [journal_middleware] if Config.JOURNAL_ENABLED else []
+    middlewares += [first_update_middleware, user_context_middleware, timeout_middleware]
+    if profile:
+        middleware_profiler.install(dp.update, middlewares)
+    else:
+        for middleware in middlewares:
+            dp.update.middleware(middleware)
+
+    # Команды
+    dp.message.register(start_command, Command("start"))
+    dp.message.register(cancel_command, Command("cancel"))
+    dp.message.register(help_command, Command("help"))
+    dp.message.register(mybookings_command, Command("mybookings"))
+    dp.message.register(stats_command, Command("stats"))
+    dp.message.register(reset_command, Command("reset"))
+    dp.message.register(clear_cache_command, Command("clearcache"))
+    dp.message.register(refresh_cache_command, Command("refresh"))
+    dp.message.register(admin_command, Command("admin"))
+
+    # Callback-обработчики в порядке приоритета
+    dp.callback_query.register(process_main_menu_button, F.data == CallbackData.MAIN_MENU)
+    dp.callback_query.register(process_main_menu, F.data.in_([
+        CallbackData.MAIN_RECORD, CallbackData.MAIN_CHECK,
+        CallbackData.MAIN_MYBOOKINGS, CallbackData.MAIN_STATS, CallbackData.MAIN_HELP
+    ]))
+    dp.callback_query.register(process_waitlist, is_waitlist_callback)
+    dp.callback_query.register(process_admin, F.data.startswith("admin_"))
+    dp.callback_query.register(process_bookings_page, is_bookings_page_callback)
+    dp.callback_query.register(process_station, Form.waiting_for_station)
+    dp.callback_query.register(process_blood_group, Form.waiting_for_blood_group)
+    dp.callback_query.register(process_date, Form.waiting_for_date)
+    dp.callback_query.register(process_time, Form.waiting_for_time)
+    # Фильтр для отмены: старый префикс cancel_ и закодированные кнопки отмены
+    dp.callback_query.register(process_cancel_booking, is_cancel_callback)
+    return dp
+
 async def main():
     logging.basicConfig(level=logging.INFO)
 
@@ -1038,15 +3279,9 @@ async def main():
     print("🚀 ЗАПУСК БОТА v5.3")
     print("=" * 50)
 
+    health_tasks = []
     if Config.MODE in ["GOOGLE", "HYBRID"]:
-        test = google_client.test_connection()
-        if test.status == "success":
-            print("✅ Google Script доступен")
-        else:
-            print(f"⚠️ Google Script недоступен: {test.data}")
-            if Config.MODE == "GOOGLE":
-                print("❌ Режим GOOGLE выбран, но сервис недоступен!")
-                return
+        health_tasks = [asyncio.create_task(upstream_health_check(adapter.google)) for adapter in stations.all()]
 
     context = ssl.create_default_context()
     connector = aiohttp.TCPConnector(ssl=context)
@@ -1055,34 +3290,27 @@ async def main():
         session._session = aiohttp_session
 
         bot = Bot(token=Config.TOKEN, session=session)
-        dp = Dispatcher(storage=MemoryStorage())
-
-        # Middleware
-        dp.update.middleware(timeout_middleware)
-
-        # Команды
-        dp.message.register(start_command, Command("start"))
-        dp.message.register(cancel_command, Command("cancel"))
-        dp.message.register(help_command, Command("help"))
-        dp.message.register(mybookings_command, Command("mybookings"))
-        dp.message.register(stats_command, Command("stats"))
-        dp.message.register(reset_command, Command("reset"))
-        dp.message.register(clear_cache_command, Command("clearcache"))
-        dp.message.register(refresh_cache_command, Command("refresh"))
-
-        # Callback-обработчики в порядке приоритета
-        dp.callback_query.register(process_main_menu_button, F.data == CallbackData.MAIN_MENU)
-        dp.callback_query.register(process_main_menu, F.data.in_([
-            CallbackData.MAIN_RECORD, CallbackData.MAIN_CHECK,
-            CallbackData.MAIN_MYBOOKINGS, CallbackData.MAIN_STATS, CallbackData.MAIN_HELP
-        ]))
-        dp.callback_query.register(process_blood_group, Form.waiting_for_blood_group)
-        dp.callback_query.register(process_date, Form.waiting_for_date)
-        dp.callback_query.register(process_time, Form.waiting_for_time)
-        # Фильтр для отмены: только те, что начинаются с префиксов
-        dp.callback_query.register(process_cancel_booking, F.data.startswith(('cancel_', 'admin_')))
-
-        print("✅ Бот готов")
+        dp = create_dispatcher()
+
+        if Config.JOURNAL_ENABLED:
+            applied = journal.restore(dp.storage)
+            print(f"[JOURNAL] Восстановлено из журнала: {applied} записей")
+            journal.open()
+            stations.subscribe(journal.on_storage_event)
+        reminders.load()
+        stations.subscribe(reminders.on_storage_event)
+        stations.subscribe(waitlist.on_storage_event)
+        stations.subscribe(dashboard.on_storage_event)
+        stations.subscribe(reports.on_storage_event)
+        # Локально статистика считается только в LOCAL; в HYBRID - лишь при отказе Google Script,
+        # и процесс поднимется при первом таком отчёте, в GOOGLE - никогда
+        if Config.MODE == "LOCAL":
+            reports.start()
+        waitlist.get().bot = bot
+        reminder_task = asyncio.create_task(reminders.run(bot))
+
+        startup_metrics["polling_started_ms"] = (time.monotonic() - STARTED_AT) * 1000
+        print(f"✅ Бот готов за {startup_metrics['polling_started_ms']:.0f} мс")
         print("=" * 50)
 
         try:
@@ -1090,6 +3318,12 @@ async def main():
         except KeyboardInterrupt:
             print("\n⚠️ Бот остановлен")
         finally:
+            for task in health_tasks:
+                task.cancel()
+            reminder_task.cancel()
+            reminders.save()
+            journal.close()
+            reports.shutdown()
             print("✅ Сессии закрыты")
 
 if __name__ == "__main__":
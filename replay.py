@@ -0,0 +1,93 @@
+"""
+🔁 ВОСПРОИЗВЕДЕНИЕ ЖУРНАЛА
+Прогоняет записанные обновления через обработчики бота без обращения к Telegram.
+Записи станций и FSM берутся из первой контрольной точки журнала - бот начинает с того же состояния,
+что и при записи. Обновления одного чата обрабатываются строго по порядку, разных чатов - параллельно.
+Запуск: python replay.py [каталог журнала] [--speed N]   (N - ускорение, 0 - без пауз)
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+# Воспроизведение работает на локальном хранилище и не пишет в журнал, который читает
+os.environ.setdefault("BOT_MODE", "LOCAL")
+os.environ["JOURNAL_ENABLED"] = "False"
+
+from aiogram import Bot
+from aiogram.types import Update
+
+import main
+from bench import NullSession
+
+
+def percentile(values, p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))] if ordered else 0.0
+
+
+def chat_id(update: dict):
+    message = update.get("message") or update.get("callback_query", {}).get("message") or {}
+    return message.get("chat", {}).get("id")
+
+
+async def replay(directory: str, speed: float):
+    journal = main.Journal(directory)
+    records = list(journal.records())
+    checkpoint = next((r for r in records if r.get("k") == "ck"), None)
+    records = [r for r in records if r.get("k") == "u"]
+    if not records:
+        print(f"В журнале {directory} нет обновлений")
+        return 1
+
+    bot = Bot(token="123456:REPLAY", session=NullSession())
+    dp = main.create_dispatcher()
+    if checkpoint:
+        journal.apply_checkpoint(checkpoint["d"], dp.storage)
+    latencies = []
+
+    async def handle(update: Update, previous):
+        if previous is not None:
+            await previous
+        start = time.perf_counter()
+        await dp.feed_update(bot, update)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    # Как при polling: отдельная задача на обновление, но задача ждёт предыдущее обновление своего чата
+    tasks = []
+    last_in_chat = {}
+    first = records[0]["t"]
+    started = time.perf_counter()
+    for record in records:
+        if speed:
+            delay = (record["t"] - first) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        update = Update.model_validate(record["d"], context={"bot": bot})
+        chat = chat_id(record["d"])
+        task = asyncio.create_task(handle(update, last_in_chat.get(chat)))
+        last_in_chat[chat] = task
+        tasks.append(task)
+    await asyncio.gather(*tasks)
+    wall = time.perf_counter() - started
+
+    print(f"\nВоспроизведено обновлений: {len(records)} за {wall:.2f} с "
+          f"(записано за {records[-1]['t'] - first:.1f} с, ускорение {speed or 'макс.'})")
+    print(f"  {'пропускная способность':<24} {len(records) / wall:>10.1f} обн/с")
+    for label, p in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0)):
+        print(f"  {label:<24} {percentile(latencies, p):>10.2f} мс")
+    return 0
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Воспроизведение журнала обновлений")
+    parser.add_argument("directory", nargs="?", default=main.Config.JOURNAL_DIR)
+    parser.add_argument("--speed", type=float, default=10.0)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    sys.exit(asyncio.run(replay(args.directory, args.speed)))